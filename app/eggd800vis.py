@@ -5,12 +5,15 @@ import subprocess
 import fnmatch
 import numpy as np
 import scipy.io.wavfile
-import scipy.signal
 import pyaudio
 import runpy
+from functools import partial
 from scipy import stats
 
-from eggd800.signal import demux, butter_lowpass_filter
+from eggd800 import instrument
+from eggd800.signal import process_mux
+from eggd800.wavmeta import cached_audio_first, set_audio_first
+from eggd800.session import FileCache, neighbours
 
 from bokeh.io import curdoc
 from bokeh.layouts import row, column, widgetbox, gridplot
@@ -101,90 +104,139 @@ def load_calibration():
     print('p1_cal: ', p1_cal)
     print('p2_cal: ', p2_cal)
 
-def calibrate(sig, slope=1.0, intercept=0.0, zero_offset=0.0):
-    '''Calibrate a signal using slope, intercept, zero.'''
-    return (sig - zero_offset - intercept) * slope
-
 def file_selected(attrname, old, wav):
-    load_file(wav)
+    if wav in files:
+        load_file(wav)
 
 def audio_first_selected(selected_elements):
+    if showing_audio_first is True:
+        return
     wav = fsel.value
-    if wav is not None and wav != '':
+    if wav in files:
+        # Remember the user's choice so the file is not reprocessed with
+        # the detected phase next time.
+        set_audio_first(os.path.join(datadir, wav), 0 in selected_elements)
+        filecache.discard(wav)
         load_file(wav)
 
+def show_audio_first(audio_first):
+    '''Set the 'audio first' checkbox without reloading the file.'''
+    global showing_audio_first
+    showing_audio_first = True
+    audio_first_checkbox.active = [0] if audio_first is True else []
+    showing_audio_first = False
+
+def step_file(direction):
+    '''Select the next (direction=1) or previous (direction=-1) file.'''
+    idx = files.index(fsel.value) + direction if fsel.value in files else 0
+    if 0 <= idx < len(files):
+        fsel.value = files[idx]
+
 def load_file(wav):
-    sys.stderr.write("++++++++++++++++++++++\n")
-    global au, orig_au, lx, orig_lx, p1, orig_p1, p2, orig_p2, lp_p1, \
-        orig_lp_p1, lp_p2, orig_lp_p2, rate, orig_rate, timepts, \
-        raw_p1, raw_p2, raw_lp_p1, raw_lp_p2, raw_lp_decim_p1, raw_lp_decim_p2
-    load_calibration()
-    print(p1_cal)
-    print(p2_cal)
-    (orig_rate, data) = scipy.io.wavfile.read(os.path.join(datadir, wav))
-
-    # 'audio first' is the 0th element in the checkbox group
-    audio_first = True
-    if 0 not in audio_first_checkbox.active:
-        audio_first = False
-    (orig_au, orig_lx, raw_p1, raw_p2) = demux(data, audio_first=audio_first)
-
-    orig_rate /= 2            # effective sample rate is half the original rate (one quarter of the EGG-D800's total rate)
-    raw_lp_p1 = butter_lowpass_filter(raw_p1, cutoff, orig_rate, order)
-    raw_lp_p2 = butter_lowpass_filter(raw_p2, cutoff, orig_rate, order)
-    if p1_cal is not None:
-        try:
-            zero_idx = p1_cal['data']['refinputs'].index(0.0)
-            zero_offset = p1_cal['data']['measurements'][zero_idx]
-        except IndexError:
-            zero_offset = 0.0
-        orig_p1 = calibrate(
-            raw_lp_p1,
-            p1_cal['regression'].slope,
-            p1_cal['regression'].intercept,
-            zero_offset
-        )
+    '''
+    Show wav, from the file cache if it has been processed already or
+    when its processing finishes in the background, and prefetch the
+    files that follow it in the session.
+    '''
+    future = filecache.submit(wav)
+    if future.done():
+        file_loaded(wav, future)
     else:
-        orig_p1 = raw_lp_p1
-    if p2_cal is not None:
+        msgdiv.text = 'Loading {}...'.format(os.path.basename(wav))
+        future.add_done_callback(
+            lambda f: doc.add_next_tick_callback(partial(file_loaded, wav, f))
+        )
+    filecache.prefetch(neighbours(files, wav, ahead=prefetch_ahead))
+
+def file_loaded(wav, future):
+    if fsel.value != wav:
+        return         # The user has moved on to another file.
+    if future.exception() is not None:
+        msgdiv.text = 'Could not load {}: {}'.format(
+            os.path.basename(wav), future.exception()
+        )
+        return
+    msgdiv.text = ''
+    with instrument.span('show_file', fname=wav):
+        show_file(future.result())
+    if instrument.enabled is True:
+        instrument.report()
+        instrument.reset()
+
+def process_file(wav):
+    '''Read and process wav for display. Return a dict of the results.'''
+    load_calibration()
+    with instrument.span('wav_read'):
+        (rate, data) = scipy.io.wavfile.read(os.path.join(datadir, wav))
+
+    # The interleave phase is detected on first load and cached with the
+    # file's metadata, or set by the user with the 'audio first' checkbox.
+    audio_first = cached_audio_first(os.path.join(datadir, wav), data)
+    cal = {}
+    for name, pcal in (('p1', p1_cal), ('p2', p2_cal)):
+        if pcal is None:
+            continue
         try:
-            zero_idx = p2_cal['data']['refinputs'].index(0.0)
-            zero_offset = p2_cal['data']['measurements'][zero_idx]
+            zero_idx = pcal['data']['refinputs'].index(0.0)
+            zero_offset = pcal['data']['measurements'][zero_idx]
         except IndexError:
             zero_offset = 0.0
-        orig_p2 = calibrate(
-            raw_lp_p2,
-            p2_cal['regression'].slope,
-            p2_cal['regression'].intercept,
-            zero_offset
-        )
+        cal[name] = {
+            'slope': pcal['regression'].slope,
+            'intercept': pcal['regression'].intercept,
+            'zero_offset': zero_offset
+        }
+    d = process_mux(
+        data, rate, audio_first=audio_first, cutoff=cutoff, order=order,
+        cal=cal, decim_factor=2, flow_on=flow_on, flow_off=flow_off
+    )
+    d['audio_first'] = audio_first
+    return d
+
+def show_file(d):
+    '''Make the processed file d, from process_file(), the current file.'''
+    global au, orig_au, lx, orig_lx, p1, orig_p1, p2, orig_p2, lp_p1, \
+        orig_lp_p1, lp_p2, orig_lp_p2, rate, orig_rate, timepts, \
+        raw_p1, raw_p2, raw_lp_p1, raw_lp_p2, raw_lp_decim_p1, raw_lp_decim_p2, \
+        events, step, loaded
+    (au, orig_au, lx, orig_lx, p1, orig_p1, p2, orig_p2) = (
+        d['au'], d['orig_au'], d['lx'], d['orig_lx'],
+        d['p1'], d['orig_p1'], d['p2'], d['orig_p2']
+    )
+    (lp_p1, orig_lp_p1, lp_p2, orig_lp_p2) = (
+        d['lp_p1'], d['orig_lp_p1'], d['lp_p2'], d['orig_lp_p2']
+    )
+    (raw_p1, raw_p2, raw_lp_p1, raw_lp_p2, raw_lp_decim_p1, raw_lp_decim_p2) = (
+        d['raw_p1'], d['raw_p2'], d['raw_lp_p1'], d['raw_lp_p2'],
+        d['raw_lp_decim_p1'], d['raw_lp_decim_p2']
+    )
+    (rate, orig_rate, timepts, events) = (
+        d['rate'], d['orig_rate'], d['timepts'], d['events']
+    )
+    show_audio_first(d['audio_first'])
+    step = None
+    loaded = None
+    update_data(0, timepts[-1])
+    x_range.update(start=0, end=timepts[-1])
+
+def jump_event(direction):
+    '''Show the next (direction=1) or previous (direction=-1) event.'''
+    iv = events.get(event_sel.value, np.zeros([0, 2]))
+    if len(iv) == 0:
+        msgdiv.text = 'No {} events.'.format(event_sel.value)
+        return
+    center = (x_range.start + x_range.end) / 2
+    mids = iv.mean(axis=1)
+    if direction > 0:
+        idx = np.searchsorted(mids, center, side='right')
     else:
-        orig_p2 = raw_lp_p2
-    orig_lp_p1 = butter_lowpass_filter(orig_p1, cutoff, orig_rate, order)
-    orig_lp_p2 = butter_lowpass_filter(orig_p2, cutoff, orig_rate, order)
-    decim_factor = 2
-    au = scipy.signal.decimate(orig_au, decim_factor)
-    lx = scipy.signal.decimate(orig_lx, decim_factor)
-    p1 = scipy.signal.decimate(orig_p1, decim_factor)
-    raw_lp_decim_p1 = scipy.signal.decimate(raw_lp_p1, decim_factor)
-    p2 = scipy.signal.decimate(orig_p2, decim_factor)
-    raw_lp_decim_p2 = scipy.signal.decimate(raw_lp_p2, decim_factor)
-    rate = orig_rate / decim_factor  # rate also reduced by decim_factor
-    print('done decimating')
-    lp_p1 = butter_lowpass_filter(p1, cutoff, rate, order)
-    lp_p2 = butter_lowpass_filter(p2, cutoff, rate, order)
-    print('done filtering 2')
-    sys.stderr.write("++++++++++++++++++++++\n")
-    timepts = np.arange(0, len(au)) / rate
-    step = np.int16(np.round(len(au) / width / 4))
-    source.data['x'] = timepts[0::step]
-    source.data['au'] = au[0::step]
-    source.data['p1'] = lp_p1[0::step]
-    source.data['raw_lp_decim_p1'] = raw_lp_p1[0::step]
-    source.data['p2'] = lp_p2[0::step]
-    source.data['raw_lp_decim_p2'] = raw_lp_p2[0::step]
-    x_range.update(end=timepts[-1])
-    sys.stderr.write("++++++++++++++++++++++\n")
+        idx = np.searchsorted(mids, center, side='left') - 1
+    idx = int(np.clip(idx, 0, len(iv) - 1))
+    (t1, t2) = iv[idx]
+    x_range.update(start=max(t1 - event_pad, 0), end=t2 + event_pad)
+    msgdiv.text = '{} {} of {}: {:0.2f}-{:0.2f}'.format(
+        event_sel.value, idx + 1, len(iv), t1, t2
+    )
 
 def make_plot():
     '''Make the plot figures.'''
@@ -200,7 +252,7 @@ def make_plot():
     )
     ts[0].line('x', 'au', source=source, tags=['update_ts'])
     ts[0].x_range.on_change('end', update_ts)
-    ts[0].circle('x', 'au', source=source, size=0.1, tags=['update_ts'])
+    ts[0].circle('x', 'au', source=source, size=0.1, tags=['points'])
     cursel = BoxAnnotation(left=0, right=0, fill_alpha=0.1, fill_color='blue', tags=['cursel'])
     ts[0].add_layout(cursel)
     ts.append(figure(
@@ -213,7 +265,7 @@ def make_plot():
         )
     )
     ts[1].line('x', 'p1', source=source, tags=['update_ts'])
-    ts[1].circle('x', 'p1', source=source, size=0.1, tags=['update_ts'])
+    ts[1].circle('x', 'p1', source=source, size=0.1, tags=['points'])
     cursel = BoxAnnotation(left=0, right=0, fill_alpha=0.1, fill_color='blue', tags=['cursel'])
     ts[1].add_layout(cursel)
     ts.append(figure(
@@ -226,7 +278,7 @@ def make_plot():
         )
     )
     ts[2].line('x', 'p2', source=source, tags=['update_ts'])
-    ts[2].circle('x', 'p2', source=source, size=0.1, tags=['update_ts'])
+    ts[2].circle('x', 'p2', source=source, size=0.1, tags=['points'])
     cursel = BoxAnnotation(left=0, right=0, fill_alpha=0.1, fill_color='blue', tags=['cursel'])
     ts[2].add_layout(cursel)
     gp = gridplot([[ts[0]], [ts[1]], [ts[2]]])
@@ -246,60 +298,81 @@ def update_ts_wrap():
     yield gen.sleep(1)
     data_update_in_progress = False
     
+def window_data(i1, i2, step):
+    '''
+    Return source columns for samples i1 to i2 at step. Times stay float64,
+    since float32 cannot resolve single samples late in long recordings;
+    signals are sent as float32.
+    '''
+    sl = slice(i1, i2, step)
+    return {
+        'x': timepts[sl],
+        'au': au[sl].astype(np.float32),
+        'p1': lp_p1[sl].astype(np.float32),
+        'raw_lp_decim_p1': raw_lp_decim_p1[sl].astype(np.float32),
+        'p2': lp_p2[sl].astype(np.float32),
+        'raw_lp_decim_p2': raw_lp_decim_p2[sl].astype(np.float32),
+    }
+
 def update_data(start, end):
-    global step
-    dur = end - start
-    if dur <= 2.0:
-        newstep = 1
-    elif dur <= 5.0:
-        newstep = np.int16(np.round(len(au) / width / 8))
-    elif dur <= 10.0:
-        newstep = np.int16(np.round(len(au) / width / 4))
-    else:
-        newstep = np.int16(np.round(len(au) / width / 2))
-    if newstep != step:
-        sys.stderr.write('Updating source data\n')
-        step = newstep
-        newsource = dict()
-        newsource['x'] = timepts[0::step]
-        newsource['au'] = au[0::step]
-        newsource['p1'] = lp_p1[0::step]
-        newsource['raw_lp_decim_p1'] = raw_lp_decim_p1[0::step]
-        newsource['p2'] = lp_p2[0::step]
-        newsource['raw_lp_decim_p2'] = raw_lp_decim_p2[0::step]
-        source.data = newsource
-        for renderer in ch0.select(dict(tag='update_ts')):
-            renderer.data_source.data = newsource
-        # TODO: should this trigger fire?
-        #source.trigger('change')
-    else:
-        sys.stderr.write('Step did not change\n')
-    print(dur, step, len(au), width)
-    
+    '''
+    Send the data for the visible time range to the client. The source
+    holds the visible range plus one range width either side, reduced to at
+    most max_points points. When the view pans right at the same step only
+    the newly exposed points are streamed. Bokeh can only stream points onto
+    the end of a source, so left pans and zooms replace the whole source.
+    '''
+    global step, loaded
+    dur = max(end - start, 1.0 / rate)
+    newstep = max(1, int(np.ceil(3 * dur * rate / max_points)))
+    # Window limits are kept on the step grid so that streamed points line
+    # up with the points already in the source.
+    i1 = max(int((start - dur) * rate), 0) // newstep * newstep
+    # The end is clamped to the data, so it is off the grid only at the end
+    # of the file, and loaded always holds the range actually sent.
+    i2 = min(int(np.ceil((end + dur) * rate / newstep)) * newstep, len(au))
+    if loaded is not None and newstep == step and loaded[0] <= \
+        int(start * rate) and min(int(end * rate), len(au)) <= loaded[1]:
+        instrument.count('source_updates_skipped')
+        return
+    with instrument.span('source_update', step=newstep):
+        if loaded is not None and newstep == step and \
+            loaded[0] <= i1 < loaded[1] < i2:
+            # Stream the new points; rollover drops the points left of i1.
+            newdata = window_data(loaded[1], i2, step)
+            source.stream(newdata, rollover=-(-(i2 - i1) // step))
+            instrument.count('source_streams')
+        else:
+            newdata = window_data(i1, i2, newstep)
+            source.data = newdata
+            instrument.count('source_replacements')
+        nbytes = sum(v.nbytes for v in newdata.values())
+        instrument.observe('source_payload_bytes', nbytes)
+    step = newstep
+    loaded = (i1, i2)
+    # Individual sample points are only useful when every sample is shown.
+    for renderer in gp.select(dict(tags=['points'])):
+        renderer.visible = (step == 1)
+
 #@gen.coroutine
 def update_ts(attr, old, new):
-    sys.stderr.write("*****update_ts_start***********\n")
     global data_update_in_progress
     if not data_update_in_progress:
-        print(attr)
-        print(old)
-        print(new)
-        print(x_range.start, x_range.end)
         data_update_in_progress = True
-        update_data(x_range.start, x_range.end)
+        with instrument.span('update_ts'):
+            update_data(x_range.start, x_range.end)
 #        curdoc().add_next_tick_callback(update_ts_wrap)
         data_update_in_progress = False
     else:
         data_update_in_progress = False
-        sys.stderr.write("--data update in progress--------------\n")
-    sys.stderr.write("*****update_ts_end***********\n")
+        instrument.count('update_ts_in_progress')
 
 def selection_change(attr, old, new):
     sys.stderr.write("*****selection_change***********\n")
     ind = new['1d']['indices']
     if len(ind) > 1:
-        x1sel = np.min(ind) * step
-        x2sel = np.max(ind) * step
+        x1sel = loaded[0] + np.min(ind) * step
+        x2sel = loaded[0] + np.max(ind) * step
         t1sel = x1sel / rate
         t2sel = x2sel / rate
         secs = t2sel - t1sel
@@ -339,20 +412,31 @@ def selection_change(attr, old, new):
 
 # Filename selector
 datadir = os.path.join(os.path.dirname(__file__), 'data')
-fsel = Select(options=['Select a file'] + get_filenames(), width=400)
+files = get_filenames()
+fsel = Select(options=['Select a file'] + files, width=400)
 
 msgdiv = Div(text='', width=400, height=50)
 
 step = None
+loaded = None      # (first, end) sample indexes of data in source
 rate = orig_rate = None
 au = orig_au = lx = orig_lx = p1 = orig_p1 = p2 = orig_p2 = []
 lp_p1 = orig_lp_p1 = lp_p2 = orig_lp_p2 = timepts = []
 raw_p1 = raw_p2 = raw_lp_p1 = raw_lp_p2 = raw_lp_decim_p1 = raw_lp_decim_p2 = []
 p1_cal = p2_cal = None
+events = {}
+flow_on = 300      # airflow onset threshold, raw units above rest
+flow_off = 150     # airflow offset threshold, raw units above rest
+event_pad = 0.25   # seconds shown either side of an event
 width = 800
 height = 200
+max_points = width * 4   # maximum points per column sent to the client
 cutoff = 50
 order = 3
+cache_size = 8       # processed files kept in memory
+prefetch_ahead = 3   # following files processed in the background
+filecache = FileCache(process_file, maxsize=cache_size)
+doc = curdoc()
 source = ColumnDataSource(
     data=dict(
         x=timepts,
@@ -388,18 +472,30 @@ tools = [
 ]
 
 data_update_in_progress = False
+showing_audio_first = False
 
+prev_file_button = Button(label='<<', width=30)
+prev_file_button.on_click(lambda: step_file(-1))
+next_file_button = Button(label='>>', width=30)
+next_file_button.on_click(lambda: step_file(1))
 play_all_button = Button(label='Play', button_type='success', width=60)
 play_all_button.on_click(play_all)
 play_all_sox_button = Button(label='Play sox', button_type='success', width=60)
 play_all_sox_button.on_click(play_all_sox)
 audio_first_checkbox = CheckboxGroup(labels=['audio first'], active=[0])
 audio_first_checkbox.on_click(audio_first_selected)
+event_sel = Select(
+    options=['voiced', 'p1 airflow', 'p2 airflow'], value='voiced', width=120
+)
+prev_event_button = Button(label='<', width=30)
+prev_event_button.on_click(lambda: jump_event(-1))
+next_event_button = Button(label='>', width=30)
+next_event_button.on_click(lambda: jump_event(1))
 
 fsel.on_change('value', file_selected)
 source.on_change('selected', selection_change)
 
-curdoc().add_root(row(fsel, play_all_button, play_all_sox_button, audio_first_checkbox, msgdiv))
+curdoc().add_root(row(prev_file_button, fsel, next_file_button, play_all_button, play_all_sox_button, audio_first_checkbox, event_sel, prev_event_button, next_event_button, msgdiv))
 (gp, ch0) = make_plot()
 x_range = ch0.x_range
 curdoc().add_root(row(gp))
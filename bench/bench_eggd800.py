@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+# Benchmarks for the signal, I/O and display hot paths of eggd800.
+
+import os, sys
+import json
+import argparse
+import contextlib
+import io
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+from pathlib import Path
+import importlib.machinery
+import importlib.util
+import numpy as np
+import scipy.io.wavfile
+import scipy.signal
+
+repodir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repodir))
+from eggd800.signal import demux, butter_lowpass_filter, process_mux, \
+    full_scale
+
+# ad7689 uses sibling imports, as in eggd800.py, and needs the package
+# directory on the path.
+sys.path.insert(0, str(repodir / 'eggd800'))
+from ad7689 import Ad7689
+
+sampledir = repodir / 'app' / 'sampledata'
+durations = (1.0, 10.0, 60.0)
+cutoff = 50
+order = 3
+
+def synth_recording(rate, secs, seed=0):
+    '''
+    Make a synthetic four-channel EGG-D800 recording: audio, a silent EGG
+    channel and two slowly varying airflow channels, as int16.
+    '''
+    rng = np.random.default_rng(seed)
+    n = int(rate * secs)
+    t = np.arange(n) / rate
+    au = 8000 * np.sin(2 * np.pi * 120 * t) * (0.5 + 0.5 * np.sin(2 * np.pi * 2 * t))
+    egg = np.zeros(n)
+    orfl = 4000 * np.clip(np.sin(2 * np.pi * 1.5 * t), 0, None)
+    nsfl = 2000 * np.clip(np.sin(2 * np.pi * 0.7 * t + 1), 0, None)
+    data = np.stack([au, egg, orfl, nsfl], axis=1)
+    data += rng.normal(0, 50, size=data.shape)
+    return data.astype(np.int16)
+
+def mux(data):
+    '''
+    Interleave a four-channel recording into the two-channel multiplexed
+    format read by `demux`, with audio first.
+    '''
+    muxed = np.empty([data.shape[0] * 2, 2], dtype=data.dtype)
+    muxed[0::2, 0] = data[:, 0]
+    muxed[0::2, 1] = data[:, 1]
+    muxed[1::2, 0] = data[:, 3]
+    muxed[1::2, 1] = data[:, 2]
+    return muxed
+
+def load_pipeline(data, rate, dtype='float64'):
+    '''
+    The processing done by the visualiser's `process_file` after reading a
+    .wav file, without calibration data, at working precision `dtype`.
+    '''
+    return process_mux(data, rate, cutoff=cutoff, order=order, dtype=dtype)
+
+def precision_error(data, rate):
+    '''
+    Return the largest absolute difference between the float32 and float64
+    outputs of `load_pipeline`, as a fraction of the input's full scale.
+    '''
+    muxed = mux(data) if data.shape[1] == 4 else data
+    ref = load_pipeline(muxed, rate, dtype='float64')
+    out = load_pipeline(muxed, rate, dtype='float32')
+    err = max(
+        float(np.max(np.abs(out[k] - ref[k])))
+        for k in ('au', 'lx', 'p1', 'p2', 'lp_p1', 'lp_p2')
+    )
+    return err / full_scale(data.dtype)
+
+def load_cli():
+    '''Load scripts/eggd800 as a module, or return None if it can't load.'''
+    loader = importlib.machinery.SourceFileLoader(
+        'eggd800_cli', str(repodir / 'scripts' / 'eggd800')
+    )
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    mod = importlib.util.module_from_spec(spec)
+    try:
+        loader.exec_module(mod)
+    except (SystemExit, Exception):
+        return None
+    return mod
+
+def measure(func, repeat):
+    '''
+    Time func over `repeat` runs and record peak traced memory of one run.
+    Return dict of best and median seconds and peak MiB.
+    '''
+    times = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t1)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'best_s': min(times),
+        'median_s': float(np.median(times)),
+        'peak_mib': peak / 2**20
+    }
+
+def stages(data, rate, wavname, cli=None):
+    '''Return dict of stage name -> callable for one recording.'''
+    muxed = mux(data) if data.shape[1] == 4 else data
+    st = {
+        'wav_read': lambda: scipy.io.wavfile.read(wavname),
+        'demux': lambda: demux(muxed),
+        'butter_lowpass_filter': lambda: butter_lowpass_filter(
+            data[:, -1], cutoff, rate, order
+        ),
+        'load_file': lambda: load_pipeline(muxed, rate),
+        'load_file_float32': lambda: load_pipeline(muxed, rate, dtype='float32'),
+    }
+    if cli is not None and data.shape[1] == 4:
+        row = SimpleNamespace(relpath='.', fname=os.path.basename(wavname))
+        rolldir = Path(wavname).parent / 'rollwav'
+        # The synthetic EGG channel is at index 1, so device '2' with copy
+        # exercises the detect-and-write path of check_chans. The synthetic
+        # signals are detected with a low margin, so any order is applied.
+        def check_chans():
+            with contextlib.redirect_stdout(io.StringIO()):
+                cli.check_chans(
+                    row, Path(wavname).parent, rolldir, device='2', copy=True,
+                    min_margin=0
+                )
+        st['check_chans'] = check_chans
+    return st
+
+def run(rates, durs, repeat, fixtures=True):
+    cli = load_cli()
+    if cli is None:
+        sys.stderr.write('Could not load scripts/eggd800; skipping check_chans.\n')
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cases = []
+        for rate in rates:
+            for secs in durs:
+                cases.append(
+                    (f'synth_{rate}_{secs:g}s', rate, synth_recording(rate, secs))
+                )
+        if fixtures is True:
+            for wav in sorted(sampledir.glob('*.wav')):
+                (rate, data) = scipy.io.wavfile.read(wav)
+                cases.append((wav.stem, rate, data))
+        for (name, rate, data) in cases:
+            wavname = os.path.join(tmpdir, f'{name}.wav')
+            scipy.io.wavfile.write(wavname, rate, data)
+            for stage, func in stages(data, rate, wavname, cli).items():
+                r = measure(func, repeat)
+                r.update({
+                    'case': name,
+                    'stage': stage,
+                    'rate': int(rate),
+                    'nchan': int(data.shape[1]),
+                    'secs': data.shape[0] / rate,
+                })
+                if stage == 'load_file_float32':
+                    r['max_err_fs'] = precision_error(data, rate)
+                results.append(r)
+                sys.stderr.write(
+                    '{case:<28} {stage:<22} {median_s:9.4f}s {peak_mib:9.1f}MiB'.format(**r)
+                )
+                if 'max_err_fs' in r:
+                    sys.stderr.write(' err {max_err_fs:.2e} FS'.format(**r))
+                sys.stderr.write('\n')
+            os.remove(wavname)
+    return results
+
+def git_rev():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=repodir, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        return None
+
+def compare(old, new):
+    '''Print median time and peak memory ratios of new / old results.'''
+    key = lambda r: (r['case'], r['stage'])
+    oldres = {key(r): r for r in json.load(open(old))['results']}
+    print(f"{'case':<28} {'stage':<22} {'time':>8} {'mem':>8}")
+    for r in json.load(open(new))['results']:
+        o = oldres.get(key(r))
+        if o is None:
+            continue
+        print('{:<28} {:<22} {:8.2f} {:8.2f}'.format(
+            r['case'], r['stage'],
+            r['median_s'] / o['median_s'],
+            r['peak_mib'] / o['peak_mib'] if o['peak_mib'] > 0 else np.nan
+        ))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark eggd800 signal, I/O and display hot paths.'
+    )
+    parser.add_argument('--rates', type=int, nargs='+', default=list(Ad7689._valid_rates))
+    parser.add_argument('--durations', type=float, nargs='+', default=list(durations))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-fixtures', action='store_true', help='Skip app sample .wav files')
+    parser.add_argument('--output', default=None, help='Write JSON results to file (default stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two JSON result files')
+    parser.add_argument('--max-err', type=float, default=1e-5, help='Largest float32 error allowed, as a fraction of full scale (default 1e-5)')
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        compare(*args.compare)
+        sys.exit(0)
+    results = {
+        'commit': git_rev(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'machine': platform.machine(),
+        'results': run(args.rates, args.durations, args.repeat, not args.no_fixtures),
+    }
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=1)
+    else:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=1)
+    over = [
+        r for r in results['results']
+        if r.get('max_err_fs', 0) > args.max_err
+    ]
+    for r in over:
+        sys.stderr.write(
+            '{case}: float32 error {max_err_fs:.2e} FS exceeds '.format(**r)
+            + f'{args.max_err:.2e} FS\n'
+        )
+    if len(over) > 0:
+        sys.exit(1)
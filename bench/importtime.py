@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# Check the startup import time of scripts/eggd800 against a budget.
+#
+# Runs `python -X importtime scripts/eggd800 --help` and fails (exit status
+# 1) if the total import time exceeds the budget or if any heavy module that
+# should be imported lazily was imported at startup. Also runs the
+# `acq --no-disp` command, with the Recorder.exe acquisition replaced by
+# writing a short silent recording, and fails if it imports any of those
+# modules.
+
+import os, sys
+import argparse
+import re
+import subprocess
+from pathlib import Path
+
+repodir = Path(__file__).resolve().parent.parent
+script = repodir / 'scripts' / 'eggd800'
+
+# Modules that must not be imported just to start the CLI.
+lazy_modules = (
+    'pandas', 'matplotlib', 'scipy.signal', 'scipy.stats', 'phonlab',
+    'PyQt5', 'sounddevice'
+)
+
+impline = re.compile(
+    r'^import time:\s+(?P<self>\d+)\s+\|\s+(?P<cumul>\d+)\s+\|(?P<indent>\s+)(?P<mod>\S+)'
+)
+
+def importtime(args=['--help']):
+    '''
+    Return (total import time in seconds, list of imported module names)
+    for a run of scripts/eggd800 with args.
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [str(repodir)] + [p for p in [env.get('PYTHONPATH')] if p]
+    )
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', str(script)] + args,
+        capture_output=True, text=True, env=env
+    )
+    total = 0
+    mods = []
+    for line in proc.stderr.splitlines():
+        m = impline.match(line)
+        if m is None:
+            continue
+        total += int(m['self'])
+        mods.append(m['mod'])
+    return (total / 1e6, mods)
+
+# Run `acq --no-disp` for a _zero_ token and a following token in a
+# temporary data directory and print the imported modules, one per line.
+acq_prog = '''
+import sys, wave, importlib.machinery, importlib.util
+loader = importlib.machinery.SourceFileLoader('eggd800_cli', sys.argv[1])
+spec = importlib.util.spec_from_loader(loader.name, loader)
+cli = importlib.util.module_from_spec(spec)
+loader.exec_module(cli)
+def run_acq(fpath, inifile, seconds):
+    with wave.open(fpath, 'wb') as w:
+        w.setnchannels(3)
+        w.setsampwidth(2)
+        w.setframerate(12000)
+        w.writeframes(bytes(3 * 2 * 1200))
+cli.run_acq = run_acq
+for item in ('_zero_', 'pa'):
+    cli.cli.main(
+        ['acq', '--spkr', 'abc', '--lang', 'eng', '--researcher', 'xyz',
+        '--item', item, '--flow', '--no-disp'],
+        standalone_mode=False
+    )
+print('\\n'.join(sorted(sys.modules)))
+'''
+
+def acq_imports():
+    '''Return the list of modules imported by a run of `acq --no-disp`.'''
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        env = dict(os.environ)
+        env.pop('USERPROFILE', None)
+        env['HOME'] = tmpdir
+        env['PYTHONPATH'] = os.pathsep.join(
+            [str(repodir)] + [p for p in [env.get('PYTHONPATH')] if p]
+        )
+        proc = subprocess.run(
+            [sys.executable, '-c', acq_prog, str(script)],
+            capture_output=True, text=True, env=env
+        )
+    if proc.returncode != 0:
+        raise RuntimeError(f'acq --no-disp failed:\n{proc.stderr}')
+    return proc.stdout.splitlines()
+
+def eager_modules(mods):
+    '''Return the lazy_modules that are in the list of module names mods.'''
+    return [
+        lm for lm in lazy_modules
+        if any(m == lm or m.startswith(lm + '.') for m in mods)
+    ]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check scripts/eggd800 startup import time.'
+    )
+    parser.add_argument('--budget', type=float, default=0.5, help='Import time budget in seconds (default 0.5)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs; the fastest is used (default 3)')
+    args = parser.parse_args()
+
+    runs = [importtime() for _ in range(args.repeat)]
+    (total, mods) = min(runs, key=lambda r: r[0])
+    eager = eager_modules(mods)
+    print(f'Import time: {total:.3f}s (budget {args.budget:.3f}s)')
+    ok = True
+    if total > args.budget:
+        print('Import time is over budget.')
+        ok = False
+    if len(eager) > 0:
+        print('Modules that should be imported lazily: ' + ', '.join(eager))
+        ok = False
+    acq_eager = eager_modules(acq_imports())
+    if len(acq_eager) > 0:
+        print('Modules imported by acq --no-disp: ' + ', '.join(acq_eager))
+        ok = False
+    sys.exit(0 if ok is True else 1)
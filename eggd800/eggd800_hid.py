@@ -1,3 +1,11 @@
+# The HID modules import each other as siblings, with the eggd800 package
+# directory on sys.path. There the name eggd800 may be eggd800.py rather than
+# the package, so fall back to instrument as a sibling module.
+try:
+    from eggd800.instrument import span, count
+except ImportError:
+    from instrument import span, count
+
 class EggD800HID(object):
     '''ABC for EGG-D800 HID elements.'''
     def __init__(self):
@@ -10,8 +18,12 @@ class EggD800HID(object):
     
     def get_input_report(self):
         '''Get an input report from the HID handle.'''
-        return self.h.get_input_report(self.report_num, self.packed_size)
+        count('hid_input_reports')
+        with span('hid_get_input_report', report_num=self.report_num):
+            return self.h.get_input_report(self.report_num, self.packed_size)
         
     def set_output_report(self):
         '''Apply current attribute settings to HID handle.'''
-        self.h.set_output_report(self.output_report)
+        count('hid_output_reports')
+        with span('hid_set_output_report', report_num=self.report_num):
+            self.h.set_output_report(self.output_report)
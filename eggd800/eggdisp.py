@@ -11,6 +11,7 @@ import scipy.signal
 import warnings
 import sounddevice as sd
 from eggd800.signal import butter_lowpass_filter
+from eggd800.render import style_ax
 from PyQt5.QtWidgets import QApplication, QWidget, QPushButton, QMessageBox
 
 # Suppress annoying warning:
@@ -123,20 +124,8 @@ def egg_display(data, rate, chan, del_btn, title='', cutoff=50, order=3, acqfile
         ax.plot(ts, cdata, scaley=False)
         ax.set_xlim((ts[0], ts[-1]))
         ax.set_ylim((data[:,cidx].min(), data[:,cidx].max()))
-        ax.axhline(color='black')
-        ax.set_title(cname)
+        style_ax(ax, cname)
         ax.callbacks.connect('xlim_changed', on_xlim_changed)
-        ax.spines['top'].set_color('none')
-        ax.spines['bottom'].set_color('none')
-        ax.spines['left'].set_color('none')
-        ax.spines['right'].set_color('none')
-        ax.tick_params(
-            axis='x',
-            which='both',
-            top=False,
-            bottom=False,
-            labelbottom=False
-        )
     tm = fig.canvas.manager.toolmanager
     tm.add_tool(
         'play',
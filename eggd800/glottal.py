@@ -0,0 +1,127 @@
+# Glottal cycle analysis of the Lx (EGG) signal.
+#
+# Glottal closure instants (GCIs) are the positive peaks of the
+# differentiated Lx signal (dEGG) and glottal opening instants (GOIs) are
+# its negative peaks. Each cycle runs from one GCI to the next, and its f0
+# and contact quotient are returned in a compact structured array rather
+# than as per-cycle Python objects.
+
+import numpy as np
+import scipy.io.wavfile
+import scipy.signal
+from eggd800.signal import demux, voiced_intervals
+from eggd800.instrument import timed
+from eggd800.pool import map_jobs
+
+# One record per glottal cycle.
+cycle_dtype = np.dtype([
+    ('gci', 'f8'),     # time of glottal closure, in seconds
+    ('goi', 'f8'),     # time of glottal opening, in seconds; NaN if not found
+    ('f0', 'f4'),      # 1 / cycle period, in Hz
+    ('cq', 'f4'),      # contact quotient, (goi - gci) / period
+])
+
+@timed('glottal_instants')
+def glottal_instants(lx, rate, f0min=60, f0max=500, rel_height=0.3,
+    blocksize=1048576):
+    '''Find glottal closure and opening instants in an Lx signal.
+lx = 1d numpy array of Lx samples; may be a view of a memory-mapped file
+rate = sample rate of lx
+f0min, f0max = f0 range in Hz
+rel_height = minimum dEGG peak height as a proportion of the block's
+  99.5th percentile of absolute dEGG
+blocksize = approximate number of samples processed at a time
+Return (gci, goi) arrays of sample indexes.
+Peaks are picked with vectorised find_peaks over overlapping blocks, so
+memory use does not depend on the length of lx.
+'''
+    n = len(lx)
+    margin = 2 * int(rate / f0min)
+    distance = max(1, int(rate / f0max))
+    gcis = [np.zeros(0, dtype=np.int64)]
+    gois = [np.zeros(0, dtype=np.int64)]
+    for start in range(0, n, blocksize):
+        lo = max(start - margin, 0)
+        hi = min(start + blocksize + margin, n)
+        x = np.asarray(lx[lo:hi], dtype=np.float64)
+        d = np.diff(x, prepend=x[0])
+        height = rel_height * np.percentile(np.abs(d), 99.5)
+        if height <= 0:
+            continue
+        for (sig, out) in ((d, gcis), (-d, gois)):
+            pk = scipy.signal.find_peaks(sig, height=height, distance=distance)[0]
+            pk += lo
+            out.append(pk[(pk >= start) & (pk < start + blocksize)])
+    return (np.concatenate(gcis), np.concatenate(gois))
+
+def in_intervals(t, iv):
+    '''Return boolean array that is True where times t fall in intervals iv.'''
+    if len(iv) == 0:
+        return np.zeros(len(t), dtype=bool)
+    idx = np.searchsorted(iv[:, 0], t, side='right') - 1
+    return (idx >= 0) & (t < iv[np.maximum(idx, 0), 1])
+
+@timed('lx_cycles')
+def lx_cycles(lx, rate, f0min=60, f0max=500, voiced_only=True,
+    blocksize=1048576):
+    '''Calculate per-cycle f0 and contact quotient of an Lx signal.
+lx = 1d numpy array of Lx samples; may be a view of a memory-mapped file
+rate = sample rate of lx
+f0min, f0max = f0 range in Hz; cycles outside this range are dropped
+voiced_only = if True, keep only cycles that start in voiced regions of lx
+blocksize = approximate number of samples processed at a time
+Return a structured array of cycle_dtype, one record per cycle.
+'''
+    gci, goi = glottal_instants(
+        lx, rate, f0min=f0min, f0max=f0max, blocksize=blocksize
+    )
+    if len(gci) < 2:
+        return np.zeros(0, dtype=cycle_dtype)
+    start = gci[:-1]
+    period = np.diff(gci)
+    # The opening of each cycle is the first GOI after its GCI.
+    seg = np.searchsorted(gci, goi, side='right') - 1
+    ok = (seg >= 0) & (seg < len(start))
+    ok[ok] &= goi[ok] < gci[seg[ok] + 1]
+    cycgoi = np.full(len(start), np.nan)
+    segs, first = np.unique(seg[ok], return_index=True)
+    cycgoi[segs] = goi[ok][first]
+
+    cycles = np.zeros(len(start), dtype=cycle_dtype)
+    cycles['gci'] = start / rate
+    cycles['goi'] = cycgoi / rate
+    cycles['f0'] = rate / period
+    cycles['cq'] = (cycgoi - start) / period
+    keep = (cycles['f0'] >= f0min) & (cycles['f0'] <= f0max)
+    if voiced_only is True:
+        voiced = voiced_intervals(
+            lx, rate, f0min=f0min, f0max=f0max, blocksize=blocksize
+        )
+        keep &= in_intervals(cycles['gci'], voiced)
+    return cycles[keep]
+
+def wav_cycles(wav, col=1, mux=False, audio_first=True, **kwargs):
+    '''Calculate glottal cycles of the Lx channel of a .wav file.
+wav = path to the .wav file
+col = column of the Lx channel
+mux = if True, the file is two-channel multiplexed data and col is ignored
+audio_first = passed to demux when mux is True
+kwargs = passed to lx_cycles
+Return a structured array of cycle_dtype.
+'''
+    (rate, data) = scipy.io.wavfile.read(wav, mmap=True)
+    if mux is True:
+        lx = demux(data, audio_first=audio_first)[1]
+        rate = rate / 2
+    else:
+        lx = data[:, col]
+    return lx_cycles(lx, rate, **kwargs)
+
+def files_cycles(jobs, processes=None):
+    '''Calculate glottal cycles of many .wav files in a process pool.
+jobs = list of (wav, kwargs) pairs, where kwargs are passed to wav_cycles
+processes = number of worker processes (default number of CPUs); if 1,
+  files are processed in the current process
+Return a list of structured arrays of cycle_dtype, in the order of jobs.
+'''
+    return map_jobs(wav_cycles, jobs, processes)
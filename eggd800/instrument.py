@@ -0,0 +1,207 @@
+# Lightweight instrumentation: named spans, counters and histograms.
+#
+# Instrumentation is off unless enabled with enable() or the
+# EGGD800_PROFILE environment variable. When off, span() returns a shared
+# no-op context manager and count()/observe() return immediately, so
+# instrumented code pays only for a flag check.
+#
+# EGGD800_PROFILE=1 prints a summary table to stderr at exit.
+# EGGD800_PROFILE=trace.json writes Chrome-trace JSON (chrome://tracing or
+# https://ui.perfetto.dev) at exit. Any other value is a filename for the
+# summary table.
+
+import os, sys
+import atexit
+import functools
+import json
+import math
+import threading
+import time
+
+enabled = False
+_dest = None
+_t0 = time.perf_counter()
+_events = []
+_counters = {}
+_hists = {}
+_lock = threading.Lock()
+
+class _NullSpan(object):
+    '''No-op span used when instrumentation is disabled.'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_nullspan = _NullSpan()
+
+class Hist(object):
+    '''Histogram of observed values with power-of-two buckets.'''
+    def __init__(self):
+        self.n = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.buckets = {}
+
+    def add(self, val):
+        self.n += 1
+        self.total += val
+        self.min = min(self.min, val)
+        self.max = max(self.max, val)
+        b = math.frexp(val)[1] if val > 0 else None
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+
+    @property
+    def mean(self):
+        return self.total / self.n if self.n > 0 else math.nan
+
+class Span(object):
+    '''Context manager that records the wall time of a named stage.'''
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        dur = end - self.start
+        with _lock:
+            _events.append((
+                self.name, self.start - _t0, dur,
+                threading.get_ident(), self.args
+            ))
+            _hists.setdefault(self.name, Hist()).add(dur)
+        return False
+
+def span(name, **args):
+    '''Return a context manager that times the enclosed block as `name`.'''
+    if enabled is False:
+        return _nullspan
+    return Span(name, args)
+
+def timed(name):
+    '''Decorator that times each call of a function as span `name`.'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if enabled is False:
+                return func(*args, **kwargs)
+            with Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    '''Increment counter `name` by n.'''
+    if enabled is False:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def observe(name, val):
+    '''Add a value to histogram `name`.'''
+    if enabled is False:
+        return
+    with _lock:
+        _hists.setdefault('#' + name, Hist()).add(val)
+
+def reset():
+    '''Discard all recorded spans, counters and histograms.'''
+    global _t0
+    with _lock:
+        _t0 = time.perf_counter()
+        del _events[:]
+        _counters.clear()
+        _hists.clear()
+
+def summary():
+    '''Return a summary table of spans, histograms and counters as a str.'''
+    lines = [
+        '{:<32} {:>7} {:>10} {:>10} {:>10} {:>10}'.format(
+            'span', 'calls', 'total_s', 'mean_ms', 'min_ms', 'max_ms'
+        )
+    ]
+    spans = sorted(
+        ((k, h) for k, h in _hists.items() if not k.startswith('#')),
+        key=lambda kh: -kh[1].total
+    )
+    for name, h in spans:
+        lines.append(
+            '{:<32} {:>7} {:>10.4f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                name, h.n, h.total, h.mean * 1e3, h.min * 1e3, h.max * 1e3
+            )
+        )
+    hists = [(k[1:], h) for k, h in sorted(_hists.items()) if k.startswith('#')]
+    if len(hists) > 0:
+        lines.append('')
+        lines.append('{:<32} {:>7} {:>12} {:>12} {:>12}'.format(
+            'histogram', 'n', 'mean', 'min', 'max'
+        ))
+        for name, h in hists:
+            lines.append('{:<32} {:>7} {:>12.4g} {:>12.4g} {:>12.4g}'.format(
+                name, h.n, h.mean, h.min, h.max
+            ))
+    if len(_counters) > 0:
+        lines.append('')
+        lines.append('{:<32} {:>12}'.format('counter', 'value'))
+        for name, val in sorted(_counters.items()):
+            lines.append('{:<32} {:>12}'.format(name, val))
+    return '\n'.join(lines) + '\n'
+
+def chrome_trace():
+    '''Return recorded spans and counters in Chrome-trace format as a dict.'''
+    pid = os.getpid()
+    events = [
+        {
+            'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+            'ts': start * 1e6, 'dur': dur * 1e6, 'args': args
+        }
+        for (name, start, dur, tid, args) in _events
+    ]
+    end = time.perf_counter() - _t0
+    for name, val in _counters.items():
+        events.append({
+            'name': name, 'ph': 'C', 'pid': pid, 'ts': end * 1e6,
+            'args': {name: val}
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def report(dest=None):
+    '''
+    Write recorded instrumentation to dest. If dest is None or '1', print
+    a summary table to stderr. If dest ends in '.json', write Chrome-trace
+    JSON. Otherwise write the summary table to the file dest.
+    '''
+    dest = _dest if dest is None else dest
+    if dest is None or dest == '1':
+        sys.stderr.write(summary())
+    elif dest.endswith('.json'):
+        with open(dest, 'w') as out:
+            json.dump(chrome_trace(), out)
+    else:
+        with open(dest, 'w') as out:
+            out.write(summary())
+
+def enable(dest='1', at_exit=True):
+    '''
+    Turn on instrumentation. If at_exit is True, report to dest when the
+    process exits.
+    '''
+    global enabled, _dest
+    if enabled is False and at_exit is True:
+        atexit.register(report)
+    enabled = True
+    _dest = dest
+
+def disable():
+    '''Turn off instrumentation. Recorded data is kept.'''
+    global enabled
+    enabled = False
+
+if os.environ.get('EGGD800_PROFILE', '') not in ('', '0'):
+    enable(os.environ['EGGD800_PROFILE'])
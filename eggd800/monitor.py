@@ -0,0 +1,187 @@
+# Live scrolling display of EGG-D800 acquisitions.
+#
+# A source yields blocks of int16 samples, either from an audio input
+# device or replayed from a .wav file. Blocks are demuxed if necessary,
+# aerodynamic channels are lowpass filtered causally, and the result is
+# written to fixed-size ring buffers that back a scrolling plot. Redraws
+# are throttled so that block processing keeps up with the input rate.
+
+import time
+import numpy as np
+import scipy.io.wavfile
+import scipy.signal
+from eggd800 import instrument
+from eggd800.signal import demux, detect_audio_first, butter_lowpass
+
+class RingBuffer(object):
+    '''Fixed-size multichannel ring buffer.'''
+    def __init__(self, nchan, size, dtype=np.float32):
+        self.data = np.zeros([size, nchan], dtype=dtype)
+        self.size = size
+        self.idx = 0         # next write position
+        self.nwritten = 0
+
+    def write(self, block):
+        '''Write a (samples, channels) block into the buffer.'''
+        n = block.shape[0]
+        if n >= self.size:
+            block = block[-self.size:]
+            n = self.size
+        end = self.idx + n
+        if end <= self.size:
+            self.data[self.idx:end] = block
+        else:
+            split = self.size - self.idx
+            self.data[self.idx:] = block[:split]
+            self.data[:n - split] = block[split:]
+        self.idx = end % self.size
+        self.nwritten += n
+
+    def ordered(self):
+        '''Return the buffer contents in time order, oldest first.'''
+        return np.roll(self.data, -self.idx, axis=0)
+
+class CausalLowpass(object):
+    '''Butterworth lowpass filter that keeps its state across blocks.'''
+    def __init__(self, nchan, cut, fs, order=3):
+        self.b, self.a = butter_lowpass(cut, fs, order=order)
+        zi = scipy.signal.lfilter_zi(self.b, self.a)
+        self.zi = np.repeat(zi[:, np.newaxis], nchan, axis=1)
+        self.primed = False
+
+    def filter(self, block):
+        '''Filter a (samples, channels) block.'''
+        if self.primed is False:
+            # Start from the steady state of the first sample to avoid a
+            # transient from zero.
+            self.zi = self.zi * block[0]
+            self.primed = True
+        y, self.zi = scipy.signal.lfilter(
+            self.b, self.a, block, axis=0, zi=self.zi
+        )
+        return y
+
+def file_source(wav, blocksize=4096, speed=1.0):
+    '''
+    Yield blocks from a .wav file. If speed is greater than 0, blocks are
+    yielded at speed times real time, e.g. 1.0 for real time and 4.0 for four
+    times as fast. If speed is 0, blocks are yielded as fast as possible.
+    '''
+    (rate, data) = scipy.io.wavfile.read(wav, mmap=True)
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+    t0 = time.perf_counter()
+    for start in range(0, data.shape[0], blocksize):
+        if speed > 0:
+            due = t0 + start / rate / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        yield np.array(data[start:start + blocksize])
+
+def device_source(rate, nchan, blocksize=4096, device=None):
+    '''Yield blocks of int16 samples from an audio input device.'''
+    import sounddevice as sd
+    with sd.InputStream(samplerate=rate, channels=nchan, dtype='int16',
+            blocksize=blocksize, device=device) as stream:
+        while True:
+            block, overflowed = stream.read(blocksize)
+            if overflowed:
+                instrument.count('monitor_input_overflows')
+            yield block
+
+class Monitor(object):
+    '''
+    Process blocks of EGG-D800 samples into per-channel ring buffers.
+
+    rate = sample rate of the input blocks
+    chan = channel names, one per output column; None for unused columns
+    mux = if True, input blocks are two-channel multiplexed data and are
+      demuxed into audio, lx, p1, p2 at half the input rate
+    audio_first = passed to demux when mux is True; if None, the phase is
+      detected from the first block
+    seconds = length of the ring buffers in seconds
+    cutoff, order = causal lowpass filter for channels other than audio and lx
+    '''
+    def __init__(self, rate, chan, mux=False, audio_first=None, seconds=5.0,
+        cutoff=50, order=3):
+        self.mux = mux
+        self.audio_first = audio_first
+        self.rate = rate / 2 if mux is True else rate
+        self.chanmap = {c: idx for idx, c in enumerate(chan) if c is not None}
+        self.names = list(self.chanmap.keys())
+        self.cols = np.array(list(self.chanmap.values()))
+        self.lpcols = np.array([
+            i for i, c in enumerate(self.names) if c not in ('audio', 'lx')
+        ], dtype=int)
+        self.lp = None
+        if len(self.lpcols) > 0:
+            self.lp = CausalLowpass(len(self.lpcols), cutoff, self.rate, order)
+        self.buf = RingBuffer(len(self.names), int(seconds * self.rate))
+        self._carry = None
+
+    def push(self, block):
+        '''Process one block of input samples.'''
+        with instrument.span('monitor_push'):
+            if self.mux is True:
+                # Keep multiplexed frames paired across blocks of odd length.
+                if self._carry is not None:
+                    block = np.concatenate([self._carry, block])
+                    self._carry = None
+                if block.shape[0] % 2 == 1:
+                    self._carry = block[-1:]
+                    block = block[:-1]
+                if self.audio_first is None:
+                    self.audio_first = detect_audio_first(
+                        block, nwin=1, winlen=block.shape[0]
+                    )[0]
+                block = np.stack(
+                    demux(block, audio_first=self.audio_first), axis=1
+                )
+            out = block[:, self.cols].astype(np.float32)
+            if self.lp is not None:
+                out[:, self.lpcols] = self.lp.filter(out[:, self.lpcols])
+            self.buf.write(out)
+
+def run_monitor(source, mon, title='', fps=10, maxpts=4000):
+    '''
+    Consume blocks from source into Monitor mon and show a scrolling plot.
+    The plot is redrawn at most fps times per second, with each channel
+    reduced to at most maxpts points.
+    '''
+    import matplotlib.pyplot as plt
+    from eggd800.render import style_ax
+
+    nsamp = mon.buf.size
+    stride = max(1, nsamp // maxpts)
+    ts = (np.arange(0, nsamp, stride) - nsamp) / mon.rate
+    fig = plt.figure(figsize=(16,5))
+    fig.canvas.manager.set_window_title(title)
+    lines = []
+    for plidx, cname in enumerate(mon.names):
+        spargs = {'sharex': fig.axes[0]} if len(fig.axes) > 0 else {}
+        ax = fig.add_subplot(len(mon.names), 1, plidx+1, **spargs)
+        lines.append(ax.plot(ts, np.zeros_like(ts))[0])
+        ax.set_xlim((ts[0], 0))
+        style_ax(ax, cname)
+    plt.show(block=False)
+
+    lastdraw = 0.0
+    for block in source:
+        if not plt.fignum_exists(fig.number):
+            break
+        mon.push(block)
+        now = time.perf_counter()
+        if now - lastdraw < 1.0 / fps:
+            continue
+        lastdraw = now
+        with instrument.span('monitor_redraw'):
+            data = mon.buf.ordered()[::stride]
+            for cidx, (ax, line) in enumerate(zip(fig.axes, lines)):
+                line.set_ydata(data[:, cidx])
+                lo, hi = data[:, cidx].min(), data[:, cidx].max()
+                pad = (hi - lo) * 0.05 + 1e-6
+                ax.set_ylim((lo - pad, hi + pad))
+            fig.canvas.draw_idle()
+            fig.canvas.flush_events()
+    return True
@@ -0,0 +1,25 @@
+# Per-file jobs run in a pool of worker processes.
+#
+# Batch commands process many .wav files independently, e.g. to render
+# overviews or find glottal cycles, and spread the files over processes
+# with map_jobs().
+
+def _run(call):
+    (func, args, kwargs) = call
+    return func(*args, **kwargs)
+
+def map_jobs(func, jobs, processes=None):
+    '''Call func once per job in a process pool.
+func = module-level function, so that it can be sent to worker processes
+jobs = list of tuples of the positional arguments of func, followed by a
+  dict of its keyword arguments
+processes = number of worker processes (default number of CPUs); if 1,
+  jobs are run in the current process
+Return a list of the results, in the order of jobs.
+'''
+    calls = [(func, job[:-1], job[-1]) for job in jobs]
+    if processes == 1:
+        return [_run(call) for call in calls]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=processes) as ex:
+        return list(ex.map(_run, calls))
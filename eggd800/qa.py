@@ -0,0 +1,106 @@
+# Quality checks of EGG-D800 recordings.
+#
+# check_wav() is run for each .wav file of a session, typically in a
+# process pool, and returns one summary row per channel. Files are read
+# through a memory map in fixed-size chunks, so memory use does not depend
+# on recording length.
+
+import os
+import numpy as np
+import scipy.io.wavfile
+from eggd800.signal import chan_features, detect_chan_order, \
+    minmax_envelope, full_scale, chanorder_min_margin
+from eggd800.wavmeta import load_meta
+from eggd800.render import thumbnail
+
+# Length in seconds of the blocks used to estimate the noise floor.
+noise_block_secs = 0.05
+
+def check_wav(wav, chan=None, zero_means=None, layout=None, silent=(),
+    thumbdir=None, chunksize=1048576, min_margin=chanorder_min_margin):
+    '''Calculate quality measures of one .wav file.
+wav = path to the .wav file
+chan = channel names, one per column (optional; default 'ch0', 'ch1', ...)
+zero_means = per-column means of the session's _zero_ token (optional)
+layout, silent = expected channel layout for channel order detection
+  (optional; see detect_chan_order); None for no detection, e.g. for _zero_
+  tokens, which are silent
+min_margin = minimum detection margin for a channel order to be suspect
+thumbdir = directory for a PNG envelope thumbnail (optional)
+Return a list of dicts, one per channel, with keys:
+  'clip_ratio' = fraction of samples at or beyond full scale
+  'dc_offset' = channel mean minus the _zero_ token mean
+  'noise_floor_db' = 10th percentile of short-block RMS, in dB re full scale
+  'duration' = length of recording in seconds
+  'chanorder_suspect' = True if detected channel order is not the expected
+    order and was detected with a margin of at least min_margin
+'''
+    st = os.stat(wav)
+    (rate, data) = scipy.io.wavfile.read(wav, mmap=True)
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+    (nsamp, nchan) = data.shape
+    if chan is None or len(chan) != nchan:
+        chan = [f'ch{idx}' for idx in range(nchan)]
+    fs = full_scale(data.dtype)
+    blocklen = max(1, int(noise_block_secs * rate))
+    chunk = max(1, chunksize // blocklen) * blocklen
+    nclip = np.zeros(nchan)
+    ssum = np.zeros(nchan)
+    blockrms = []
+    for start in range(0, nsamp, chunk):
+        block = np.asarray(data[start:start + chunk], dtype=np.float64)
+        nclip += np.count_nonzero(np.abs(block) >= fs, axis=0)
+        ssum += block.sum(axis=0)
+        nblk = block.shape[0] // blocklen
+        if nblk > 0:
+            blk = block[:nblk * blocklen].reshape([nblk, blocklen, nchan])
+            blockrms.append(blk.std(axis=1))
+    means = ssum / max(nsamp, 1)
+    if len(blockrms) > 0:
+        floor = np.percentile(np.concatenate(blockrms), 10, axis=0)
+    else:
+        floor = np.full(nchan, np.nan)
+    floor_db = 20 * np.log10(np.maximum(floor, 1e-9) / fs)
+    if zero_means is None or len(zero_means) != nchan:
+        zero_means = np.zeros(nchan)
+
+    md = load_meta(wav)
+    order = md.get('chanorder')
+    margin = md.get('chanorder_margin', np.nan)
+    if order is None and layout is not None and len(layout) == nchan:
+        order, margin = detect_chan_order(
+            chan_features(data, rate), layout, silent=silent
+        )
+    suspect = None
+    if order is not None:
+        suspect = bool(order != list(range(nchan)) and margin >= min_margin)
+
+    thumb = None
+    if thumbdir is not None:
+        (lo, hi, binsize) = minmax_envelope(data, 400, chunksize=chunksize)
+        thumb = thumbnail(
+            os.path.join(thumbdir, os.path.basename(wav)[:-4] + '.png'),
+            lo, hi, rate, binsize, chan
+        )
+
+    rows = []
+    for cidx, cname in enumerate(chan):
+        rows.append({
+            'wav': str(wav),
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'mtime_ns': st.st_mtime_ns,
+            'rate': int(rate),
+            'duration': nsamp / rate,
+            'chan_idx': cidx,
+            'chan': cname,
+            'clip_ratio': nclip[cidx] / max(nsamp, 1),
+            'dc_offset': means[cidx] - zero_means[cidx],
+            'noise_floor_db': floor_db[cidx],
+            'chanorder': None if order is None else ','.join(str(o) for o in order),
+            'chanorder_margin': margin,
+            'chanorder_suspect': suspect,
+            'thumbnail': thumb,
+        })
+    return rows
@@ -0,0 +1,219 @@
+# Headless rendering of EGG-D800 recordings.
+#
+# Overview images use the channel layout and lowpass filtering of
+# egg_display() but are drawn from min/max envelopes with the Agg backend,
+# so they need no display and the drawing cost does not depend on recording
+# length. Envelopes are computed in one pass over a memory-mapped file and
+# cached in <stem>.env.npz next to the image, so an image can be redrawn,
+# e.g. in another format, without reading the recording again.
+
+import os
+import json
+import numpy as np
+import scipy.io.wavfile
+from eggd800.signal import butter_lowpass_filter, minmax_envelope
+from eggd800 import instrument
+from eggd800.instrument import timed
+from eggd800.pool import map_jobs
+
+# Sample rate that filtered channels are reduced to before lowpass filtering,
+# as a multiple of the filter cutoff.
+reduce_factor = 20
+
+def style_ax(ax, cname):
+    '''Apply the channel title and plain styling of an egg_display axis.'''
+    ax.axhline(color='black')
+    ax.set_title(cname)
+    ax.spines['top'].set_color('none')
+    ax.spines['bottom'].set_color('none')
+    ax.spines['left'].set_color('none')
+    ax.spines['right'].set_color('none')
+    ax.tick_params(
+        axis='x',
+        which='both',
+        top=False,
+        bottom=False,
+        labelbottom=False
+    )
+
+def thumbnail(fname, lo, hi, rate, binsize, chan, width=4.0, dpi=100):
+    '''Write a PNG of the min/max envelopes of each channel.'''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(width, 0.6 * len(chan)), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ts = np.arange(lo.shape[0]) * binsize / rate
+    for cidx, cname in enumerate(chan):
+        ax = fig.add_subplot(len(chan), 1, cidx + 1)
+        ax.fill_between(ts, lo[:, cidx], hi[:, cidx], linewidth=0)
+        ax.set_xlim((0, ts[-1] if len(ts) > 1 else 1))
+        ax.set_axis_off()
+        ax.text(0, 1, cname, transform=ax.transAxes, fontsize=6, va='top')
+    fig.subplots_adjust(left=0, right=1, top=1, bottom=0, hspace=0.1)
+    fig.savefig(fname)
+    return fname
+
+def _reduced_lowpass(data, cidx, rate, cutoff, order, chunksize):
+    '''
+    Lowpass filter column cidx of data after reducing it by block means to
+    about reduce_factor * cutoff Hz. Return (filtered, factor, min, max),
+    where min and max are of the unfiltered column.
+    '''
+    q = max(1, int(rate // (reduce_factor * cutoff)))
+    n = data.shape[0] - data.shape[0] % q
+    chunk = max(1, chunksize // q) * q
+    means = []
+    (cmin, cmax) = (np.inf, -np.inf)
+    for start in range(0, n, chunk):
+        block = np.asarray(data[start:min(start + chunk, n), cidx])
+        cmin = min(cmin, block.min())
+        cmax = max(cmax, block.max())
+        means.append(block.reshape([-1, q]).mean(axis=1))
+    reduced = np.concatenate(means) if len(means) > 0 else np.zeros(0)
+    if len(reduced) > 3 * (order + 1):
+        reduced = butter_lowpass_filter(reduced, cutoff, rate / q, order)
+    return (reduced, q, float(cmin), float(cmax))
+
+@timed('overview_envelopes')
+def overview_envelopes(data, rate, chan, npts=2000, cutoff=50, order=3,
+    chunksize=1048576):
+    '''Calculate the min/max envelopes drawn by render_overview().
+data = multichannel numpy array, one column per channel; may be memory-mapped
+rate = sample rate of data
+chan = list of channel names, one per column of data; None for unused columns
+npts = number of envelope points
+cutoff, order = lowpass filter applied to channels other than audio and lx,
+  as in egg_display
+Return (lo, hi, binsize, lims). lo and hi have one column per channel of
+data and lims holds the minimum and maximum of each unfiltered column.
+Filtered channels are reduced by block means before filtering, so they are
+approximations of egg_display's filtered signal at the envelope resolution.
+'''
+    (lo, hi, binsize) = minmax_envelope(data, npts, chunksize=chunksize)
+    lo = lo.astype(np.float32)
+    hi = hi.astype(np.float32)
+    lims = np.stack([lo.min(axis=0), hi.max(axis=0)], axis=1)
+    for cidx, cname in enumerate(chan):
+        if cname is None or cname in ('audio', 'lx'):
+            continue
+        (sig, q, cmin, cmax) = _reduced_lowpass(
+            data, cidx, rate, cutoff, order, chunksize
+        )
+        if len(sig) == 0:
+            continue
+        # Bins of the reduced signal that cover the same samples as the
+        # bins of the unfiltered envelope.
+        idx = np.minimum(np.arange(lo.shape[0]) * binsize // q, len(sig) - 1)
+        lo[:, cidx] = np.minimum.reduceat(sig, idx)
+        hi[:, cidx] = np.maximum.reduceat(sig, idx)
+        lims[cidx] = (cmin, cmax)
+    return (lo, hi, binsize, lims)
+
+def envelope_path(wav, cachedir):
+    '''Return the path of the cached overview envelopes of wav in cachedir.'''
+    stem = os.path.splitext(os.path.basename(wav))[0]
+    return os.path.join(cachedir, stem + '.env.npz')
+
+def cached_envelopes(wav, chan, cachedir, npts=2000, cutoff=50, order=3):
+    '''
+    Return (rate, lo, hi, binsize, lims) of overview_envelopes() for the
+    .wav file wav. The envelopes are cached in envelope_path(wav, cachedir)
+    with the size and modification time of wav and the envelope parameters,
+    and are recalculated if any of them change. A cache that cannot be
+    written is skipped.
+    '''
+    st = os.stat(wav)
+    params = json.dumps({
+        'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+        'npts': npts, 'cutoff': cutoff, 'order': order,
+        'chan': [str(c) for c in chan]
+    }, sort_keys=True)
+    envfile = envelope_path(wav, cachedir)
+    try:
+        with np.load(envfile) as env:
+            if str(env['params']) == params:
+                instrument.count('envelope_cache_hits')
+                return (
+                    float(env['rate']), env['lo'], env['hi'],
+                    int(env['binsize']), env['lims']
+                )
+    except (OSError, KeyError, ValueError):
+        pass
+    (rate, data) = scipy.io.wavfile.read(wav, mmap=True)
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+    (lo, hi, binsize, lims) = overview_envelopes(
+        data, rate, chan, npts=npts, cutoff=cutoff, order=order
+    )
+    try:
+        np.savez(
+            envfile, rate=rate, lo=lo, hi=hi, binsize=binsize, lims=lims,
+            params=params
+        )
+    except OSError:
+        pass
+    return (float(rate), lo, hi, binsize, lims)
+
+def render_overview(fname, lo, hi, rate, binsize, chan, lims=None,
+    chanmeans=[], title='', figsize=(16, 5), dpi=100):
+    '''Draw min/max envelopes with the layout of egg_display to an image.
+fname = output file; the format is taken from its extension, e.g. .png, .svg
+lo, hi, binsize = envelopes from overview_envelopes()
+chan = list of channel names, one per column of lo and hi; None for unused
+  columns
+lims = (min, max) y limits of each column (optional; default envelope range)
+chanmeans = per-column means to subtract, as in wav_display (optional)
+'''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    if lims is None:
+        lims = np.stack([lo.min(axis=0), hi.max(axis=0)], axis=1)
+    if len(chanmeans) != lo.shape[1]:
+        chanmeans = np.zeros(lo.shape[1])
+    chanmap = {c: idx for idx, c in enumerate(chan) if c is not None}
+    ts = np.arange(lo.shape[0]) * binsize / rate
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    if title != '':
+        fig.suptitle(title, fontsize=8)
+    for plidx, (cname, cidx) in enumerate(chanmap.items()):
+        spargs = {'sharex': fig.axes[0]} if len(fig.axes) > 0 else {}
+        ax = fig.add_subplot(len(chanmap), 1, plidx+1, **spargs)
+        m = chanmeans[cidx]
+        ax.fill_between(
+            ts, lo[:, cidx] - m, hi[:, cidx] - m, linewidth=0.5
+        )
+        ax.set_xlim((ts[0], ts[-1] if len(ts) > 1 else ts[0] + 1))
+        if lims[cidx][1] > lims[cidx][0]:
+            ax.set_ylim((lims[cidx][0] - m, lims[cidx][1] - m))
+        style_ax(ax, cname)
+    fig.savefig(fname)
+    return fname
+
+def render_wav(wav, fname, chan, chanmeans=[], npts=2000, cutoff=50,
+    order=3, cachedir=None, **kwargs):
+    '''Render an overview of the .wav file wav to fname.
+cachedir = directory of the envelope cache (default the directory of fname)
+kwargs are passed to render_overview.
+'''
+    if cachedir is None:
+        cachedir = os.path.dirname(os.path.abspath(fname))
+    with instrument.span('render_wav', fname=str(wav)):
+        (rate, lo, hi, binsize, lims) = cached_envelopes(
+            wav, chan, cachedir, npts=npts, cutoff=cutoff, order=order
+        )
+        kwargs.setdefault('title', os.path.basename(wav))
+        return render_overview(
+            fname, lo, hi, rate, binsize, chan, lims=lims,
+            chanmeans=chanmeans, **kwargs
+        )
+
+def render_files(jobs, processes=None):
+    '''Render overviews of many .wav files in a process pool.
+jobs = list of (wav, fname, kwargs) tuples, where kwargs are passed to
+  render_wav and must include 'chan'
+processes = number of worker processes (default number of CPUs); if 1,
+  files are rendered in the current process
+Return a list of the output filenames, in the order of jobs.
+'''
+    return map_jobs(render_wav, jobs, processes)
@@ -0,0 +1,135 @@
+# Browse the recordings of a session without waiting on each file.
+#
+# A FileCache holds the processed data of the most recently used files and
+# processes files in a background worker thread on request. A browser asks
+# it to prefetch the next few files of the session listing while the
+# current one is shown, so that stepping through the session usually finds
+# the next file already processed. The processing function runs mostly in
+# numpy and scipy code that releases the GIL, so a thread does not stall
+# the GUI.
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from eggd800 import instrument
+
+def neighbours(files, current, ahead=3, behind=1):
+    '''
+    Return the files after (up to `ahead`) and before (up to `behind`)
+    `current` in the list `files`, nearest first.
+    '''
+    try:
+        idx = files.index(current)
+    except ValueError:
+        return files[:ahead]
+    after = files[idx + 1:idx + 1 + ahead]
+    before = files[max(idx - behind, 0):idx][::-1]
+    return after + before
+
+class FileCache(object):
+    '''Bounded LRU cache of processed files, filled on demand or in the
+background. Files requested with get() or submit() go ahead of prefetches
+that have not started.
+load = function that takes a filename and returns its processed data
+maxsize = maximum number of processed files kept in memory
+workers = number of background worker threads
+'''
+    def __init__(self, load, maxsize=8, workers=1):
+        self.load = load
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._prefetching = set()
+        self._lock = threading.RLock()
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='eggd800-prefetch'
+        )
+
+    def __contains__(self, fname):
+        with self._lock:
+            return fname in self._cache
+
+    def __len__(self):
+        with self._lock:
+            return len(self._cache)
+
+    def _store(self, fname, future):
+        with self._lock:
+            if self._pending.get(fname) is not future:
+                return         # Discarded while loading.
+            del self._pending[fname]
+            self._prefetching.discard(fname)
+            if future.cancelled() or future.exception() is not None:
+                return
+            self._cache[fname] = future.result()
+            self._cache.move_to_end(fname)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+                instrument.count('file_cache_evictions')
+
+    def _load(self, fname):
+        with instrument.span('file_cache_load', fname=fname):
+            return self.load(fname)
+
+    def submit(self, fname, prefetch=False):
+        '''
+        Return a Future for the processed data of fname, loading it in the
+        background if it is not already cached or loading.
+        '''
+        with self._lock:
+            if fname in self._cache:
+                self._cache.move_to_end(fname)
+                if prefetch is False:
+                    instrument.count('file_cache_hits')
+                future = Future()
+                future.set_result(self._cache[fname])
+                return future
+            if fname in self._pending:
+                if prefetch is False:
+                    instrument.count('file_cache_pending_hits')
+                    self._prefetching.discard(fname)
+                return self._pending[fname]
+            if prefetch is True:
+                instrument.count('file_cache_prefetches')
+                self._prefetching.add(fname)
+            else:
+                instrument.count('file_cache_misses')
+                self._cancel_prefetches()
+            future = self._pool.submit(self._load, fname)
+            self._pending[fname] = future
+        future.add_done_callback(lambda f: self._store(fname, f))
+        return future
+
+    def _cancel_prefetches(self):
+        '''Cancel prefetches that have not started.'''
+        for fname in list(self._prefetching):
+            if self._pending[fname].cancel():
+                instrument.count('file_cache_prefetches_cancelled')
+
+    def get(self, fname):
+        '''Return the processed data of fname, waiting for it if necessary.'''
+        return self.submit(fname).result()
+
+    def prefetch(self, fnames):
+        '''
+        Start background loads of fnames that are not cached or loading,
+        up to one fewer than the cache holds so the current file is kept.
+        '''
+        for fname in fnames[:self.maxsize - 1]:
+            self.submit(fname, prefetch=True)
+
+    def discard(self, fname):
+        '''Forget fname, e.g. after its processing parameters change.'''
+        with self._lock:
+            self._cache.pop(fname, None)
+            self._pending.pop(fname, None)
+            self._prefetching.discard(fname)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._pending.clear()
+            self._prefetching.clear()
+
+    def shutdown(self, wait=False):
+        self._pool.shutdown(wait=wait, cancel_futures=True)
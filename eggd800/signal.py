@@ -1,7 +1,46 @@
 # Utility functions for working with EGG-D800 signals.
 
+import os
+import numpy as np
+import scipy.optimize
 import scipy.signal
+from eggd800.instrument import timed
 
+# Working precision of the filtering, calibration and decimation functions
+# below. 'float64' reproduces the original results exactly. 'float32' halves
+# the memory of every intermediate copy of a channel; the EGG-D800 samples
+# are 16-bit so float32 (24-bit mantissa) still represents them exactly.
+# Set with set_precision() or the EGGD800_PRECISION environment variable.
+precisions = ('float64', 'float32')
+precision = os.environ.get('EGGD800_PRECISION', 'float64')
+if precision not in precisions:
+    precision = 'float64'
+
+def set_precision(p):
+    '''Set the default working precision, one of `precisions`.'''
+    global precision
+    if p not in precisions:
+        raise RuntimeError(
+            f"Unknown precision '{p}'; must be one of {', '.join(precisions)}."
+        )
+    precision = p
+
+def work_dtype(dtype=None):
+    '''Return the working float dtype, `dtype` if given else the default.'''
+    return np.dtype(precision if dtype is None else dtype)
+
+def as_work(data, dtype=None, copy=False):
+    '''Return data as a working float array.
+data = numpy array, e.g. an int16 channel or a memory-mapped column
+dtype = working dtype; the default precision if None
+copy = if True, always return a new array that is safe to modify in place
+'''
+    dtype = work_dtype(dtype)
+    if copy is False and data.dtype == dtype:
+        return data
+    return np.array(data, dtype=dtype)
+
+@timed('demux')
 def demux(data, aero=True, audio_first=True):
     '''Separate a multiplexed EGG-D800 signal.
 data = two-channel numpy array of multiplexed signal data
@@ -29,14 +68,493 @@ audio_first = if True, first sample contains audio data; if False,
         vals = [au, lx]
     return vals
  
+def detect_audio_first(data, nwin=8, winlen=8192, threshold=1.0,
+    default=True):
+    '''Detect the interleave phase of a multiplexed EGG-D800 signal.
+data = two-channel numpy array of multiplexed signal data; may be memory-mapped
+nwin = number of windows, spread evenly over data, to examine
+winlen = length of each window in samples
+threshold = minimum absolute score for a detection
+default = value returned for audio_first when the score is below threshold
+Return (audio_first, score). Audio and lx samples have much more
+high-frequency energy relative to their variance than the slowly varying
+aerodynamic samples, and score is the mean log ratio of this roughness in
+the even samples to that of the odd samples. A positive score means the
+first sample contains audio data.
+'''
+    nframes = data.shape[0] - data.shape[0] % 2
+    winlen = min(winlen - winlen % 2, nframes)
+    starts = np.linspace(0, nframes - winlen, nwin).astype(int)
+    starts -= starts % 2
+    scores = []
+    for start in np.unique(starts):
+        x = np.asarray(data[start:start + winlen], dtype=np.float64)
+        rough = []
+        for phase in (0, 1):
+            ph = x[phase::2]
+            rough.append(
+                np.diff(ph, axis=0).var(axis=0) / (ph.var(axis=0) + 1e-9)
+            )
+        scores.append(np.sum(np.log(rough[0] + 1e-9) - np.log(rough[1] + 1e-9)))
+    score = float(np.mean(scores))
+    if abs(score) < threshold:
+        return (default, score)
+    return (score > 0, score)
+
 def butter_lowpass(cut, fs, order=3):
     nyq = 0.5 * fs
     cut = cut / nyq
     b, a = scipy.signal.butter(order, cut, btype='low')
     return b, a
 
-def butter_lowpass_filter(data, cut, fs, order=3):
+def _sosfiltfilt_blocks(sos, x, dtype, blocksize=1048576):
+    '''Zero-phase filter x with second-order sections in place in a padded
+copy of dtype. Each block is filtered in float64 with the filter state
+carried between blocks, so only the stored signal is in reduced precision.
+Padding and initial conditions are those of scipy.signal.sosfiltfilt.
+'''
+    n = len(x)
+    ntaps = 2 * len(sos) + 1
+    ntaps -= min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum())
+    edge = min(3 * ntaps, n - 1)
+    y = np.empty(n + 2 * edge, dtype=dtype)
+    y[edge:n + edge] = x
+    if edge > 0:
+        y[:edge] = 2 * y[edge] - y[2 * edge:edge:-1]
+        y[n + edge:] = 2 * y[n + edge - 1] - y[n + edge - 2:n - 2:-1]
+    zi = scipy.signal.sosfilt_zi(sos)
+    state = zi * float(y[0])
+    for start in range(0, len(y), blocksize):
+        blk = y[start:start + blocksize]
+        (blk[:], state) = scipy.signal.sosfilt(
+            sos, blk.astype(np.float64), zi=state
+        )
+    state = zi * float(y[-1])
+    for stop in range(len(y), 0, -blocksize):
+        blk = y[max(stop - blocksize, 0):stop][::-1]
+        (blk[:], state) = scipy.signal.sosfilt(
+            sos, blk.astype(np.float64), zi=state
+        )
+    return y[edge:n + edge]
+
+@timed('butter_lowpass_filter')
+def butter_lowpass_filter(data, cut, fs, order=3, dtype=None):
+    '''Zero-phase Butterworth lowpass filter of data at the working precision.
+In float32 the result is float32 and the filter runs blockwise as
+second-order sections, so temporary float64 memory is bounded by the block
+size. In float64 the result is the same as filtfilt() of the transfer
+function.
+'''
+    dtype = work_dtype(dtype)
+    if dtype == np.float32:
+        nyq = 0.5 * fs
+        sos = scipy.signal.butter(order, cut / nyq, btype='low', output='sos')
+        return _sosfiltfilt_blocks(sos, data, dtype)
     b, a = butter_lowpass(cut, fs, order=order)
     y = scipy.signal.filtfilt(b, a, data)
     return y
 
+def calibrate(sig, slope=1.0, intercept=0.0, zero_offset=0.0, inplace=False):
+    '''Calibrate a signal using slope, intercept, zero.
+If inplace is True and sig is a float array, overwrite and return sig.
+'''
+    if inplace is True and np.issubdtype(sig.dtype, np.floating):
+        sig -= zero_offset + intercept
+        sig *= slope
+        return sig
+    return (sig - zero_offset - intercept) * slope
+
+@timed('decimate')
+def decimate(data, q, dtype=None):
+    '''Downsample data by integer factor q with scipy.signal.decimate at the
+working precision. Float32 input stays float32.'''
+    return scipy.signal.decimate(as_work(data, dtype), q)
+
+@timed('process_channels')
+def process_channels(data, rate, chan, chanmeans=[], cutoff=50, order=3,
+    cal={}, dtype=None):
+    '''Process a multichannel recording into a dict of named float32 channels.
+data = multichannel numpy array, one column per channel
+rate = sample rate of data
+chan = list of channel names, one per column of data; None for unused columns
+chanmeans = per-column means to subtract, e.g. from a _zero_ token (optional)
+cutoff, order = lowpass filter applied to channels other than audio and lx
+cal = dict of calibration values keyed by channel name, where each value
+  is a dict of 'slope', 'intercept' and 'zero_offset' (optional)
+dtype = working precision; the default precision if None
+'''
+    chans = {}
+    for cidx, cname in enumerate(chan):
+        if cname is None:
+            continue
+        cdata = as_work(data[:, cidx], dtype, copy=True)
+        if len(chanmeans) == data.shape[1]:
+            cdata -= chanmeans[cidx]
+        if cname not in ('audio', 'lx'):
+            cdata = butter_lowpass_filter(cdata, cutoff, rate, order, dtype)
+        if cname in cal:
+            cdata = calibrate(
+                cdata,
+                cal[cname]['slope'],
+                cal[cname]['intercept'],
+                cal[cname]['zero_offset'],
+                inplace=True
+            )
+        chans[cname] = cdata.astype(np.float32, copy=False)
+    return chans
+
+# Kinds of signal expected on each named channel, for channel order detection.
+chan_kinds = {
+    'audio': 'audio',
+    'lx': 'lx',
+    'egg': 'lx',
+    'orfl': 'aero',
+    'nsfl': 'aero',
+    'oralf': 'aero',
+    'oralp': 'aero',
+    'p1': 'aero',
+    'p2': 'aero',
+}
+
+def chan_features(data, rate, seconds=10.0, blocksize=65536, lfcut=50):
+    '''Calculate cheap per-channel features over a prefix of a recording.
+data = multichannel numpy array, one column per channel; may be memory-mapped
+rate = sample rate of data
+seconds = length of the prefix to examine; None for the whole recording
+blocksize = number of samples processed at a time
+lfcut = cutoff frequency below which energy counts as low-frequency
+Return a dict of per-channel arrays:
+  'rms' = root mean square about the channel mean
+  'zcr' = zero crossings per second about the channel mean
+  'lf_ratio' = fraction of the channel's energy below lfcut
+'''
+    nsamp = data.shape[0]
+    if seconds is not None:
+        nsamp = min(nsamp, int(seconds * rate))
+    nchan = data.shape[1]
+    b, a = butter_lowpass(lfcut, rate, order=2)
+    n = 0
+    ssum = np.zeros(nchan)
+    sqsum = np.zeros(nchan)
+    lfsqsum = np.zeros(nchan)
+    zc = np.zeros(nchan)
+    center = None
+    zi = None
+    prevpos = None
+    for start in range(0, nsamp, blocksize):
+        block = np.asarray(
+            data[start:min(start + blocksize, nsamp)], dtype=np.float64
+        )
+        if center is None:
+            # Center on the first block's mean so that features can be
+            # accumulated in a single pass.
+            center = block.mean(axis=0)
+            zi = scipy.signal.lfilter_zi(b, a)[:, np.newaxis] * \
+                (block[0] - center)
+        block -= center
+        n += block.shape[0]
+        ssum += block.sum(axis=0)
+        sqsum += (block ** 2).sum(axis=0)
+        pos = block > 0
+        zc += np.count_nonzero(np.diff(pos, axis=0), axis=0)
+        if prevpos is not None:
+            zc += pos[0] != prevpos
+        prevpos = pos[-1]
+        lf, zi = scipy.signal.lfilter(b, a, block, axis=0, zi=zi)
+        lfsqsum += (lf ** 2).sum(axis=0)
+    var = np.maximum(sqsum / n - (ssum / n) ** 2, 0)
+    return {
+        'rms': np.sqrt(var),
+        'zcr': zc / (n / rate),
+        'lf_ratio': np.clip(lfsqsum / np.maximum(sqsum, 1e-12), 0, 1),
+    }
+
+def _kind_scores(feats):
+    '''Return dict of kind -> per-channel score of fit to that kind.'''
+    lrms = np.log10(feats['rms'] + 1)
+    rel = lrms - lrms.max()        # decades below the loudest channel
+    zcr = feats['zcr'] / max(feats['zcr'].max(), 1e-12)
+    lf = feats['lf_ratio']
+    voice = zcr - lf + rel
+    return {
+        'audio': voice,
+        'lx': voice,
+        'aero': lf - zcr,
+        'silent': -rel,
+    }
+
+# Minimum detect_chan_order() margin for a detected channel order to be
+# trusted. Recordings of speech score well above it, and recordings of noise
+# only, e.g. with nothing connected, score below it.
+chanorder_min_margin = 2.0
+
+def detect_chan_order(feats, layout, silent=(), rotations=True):
+    '''Detect the channel order of a recording from its channel features.
+feats = dict of per-channel features from chan_features
+layout = expected channel names, one per column, e.g.
+  ['audio', 'lx', 'orfl', 'nsfl']
+silent = names in layout of channels that are expected to be inactive
+rotations = if True, only consider rotations of the channels, which is how
+  channels are misordered by the recording software; if False, consider
+  all permutations, in which case channels of the same kind, e.g. two
+  airflow channels, cannot be told apart
+Return (order, margin). order is a list such that column order[i] of the
+recording holds channel layout[i], and margin is the difference in score
+between the detected order and the next best, where 0 means no preference.
+Ties are resolved in favour of the expected order. Orders with a margin
+below chanorder_min_margin are unreliable.
+'''
+    nchan = len(layout)
+    if len(feats['rms']) != nchan:
+        raise RuntimeError(
+            'Expected {:} channels but found {:}.'.format(nchan, len(feats['rms']))
+        )
+    scores = _kind_scores(feats)
+    kinds = [
+        'silent' if c in silent else chan_kinds.get(c, 'silent')
+        for c in layout
+    ]
+    # score[i, j] = fit of column j to expected channel i
+    score = np.stack([scores[k] for k in kinds])
+    if rotations is True:
+        idx = np.arange(nchan)
+        totals = np.array([
+            score[idx, (idx - k) % nchan].sum() for k in range(nchan)
+        ])
+        best = int(np.argmax(totals))
+        order = [int(j) for j in (idx - best) % nchan]
+        others = np.delete(totals, best)
+        margin = totals[best] - others.max() if len(others) > 0 else 0.0
+    else:
+        rows, cols = scipy.optimize.linear_sum_assignment(-score)
+        order = [int(j) for j in cols[np.argsort(rows)]]
+        total = score[np.arange(nchan), order].sum()
+        ident = score[np.arange(nchan), np.arange(nchan)].sum()
+        if np.isclose(total, ident):
+            order = list(range(nchan))
+        margin = total - ident if order != list(range(nchan)) else 0.0
+    return (order, float(margin))
+
+def permute_chan(vals, order):
+    '''
+    Rearrange per-channel values from expected channel order into the
+    column order of a recording, e.g. so that channel names can be used
+    to index the recording's columns without copying it.
+    '''
+    out = [None] * len(vals)
+    for i, j in enumerate(order):
+        out[j] = vals[i]
+    return out
+
+def minmax_envelope(data, npts, chunksize=1048576):
+    '''Calculate the min/max envelope of a signal.
+data = numpy array of samples, one column per channel; may be memory-mapped
+npts = number of envelope points
+chunksize = approximate number of samples processed at a time
+Return (lo, hi, binsize), where lo and hi are the minimum and maximum of
+each bin of binsize samples, with the same number of dimensions as data.
+'''
+    n = data.shape[0]
+    binsize = max(1, int(np.ceil(n / npts)))
+    chunk = max(1, chunksize // binsize) * binsize
+    lo = []
+    hi = []
+    for start in range(0, n, chunk):
+        block = np.asarray(data[start:start + chunk])
+        idx = np.arange(0, block.shape[0], binsize)
+        lo.append(np.minimum.reduceat(block, idx, axis=0))
+        hi.append(np.maximum.reduceat(block, idx, axis=0))
+    return (np.concatenate(lo), np.concatenate(hi), binsize)
+
+def full_scale(dtype):
+    '''Return the full-scale value of samples of dtype.'''
+    if np.issubdtype(dtype, np.integer):
+        return float(np.iinfo(dtype).max)
+    return 1.0
+
+def _frame_blocks(sig, framelen, blocksize):
+    '''
+    Yield consecutive blocks of whole frames of sig as float64 arrays of
+    shape (frames, framelen). A partial frame at the end is dropped.
+    '''
+    nframes = len(sig) // framelen
+    per = max(1, blocksize // framelen)
+    for f1 in range(0, nframes, per):
+        f2 = min(f1 + per, nframes)
+        block = np.asarray(sig[f1 * framelen:f2 * framelen], dtype=np.float64)
+        yield block.reshape([f2 - f1, framelen])
+
+def hysteresis(x, on, off, initial=False):
+    '''
+    Return boolean state of x with hysteresis: the state turns on where x
+    rises above `on` and off where it falls below `off`, and otherwise keeps
+    its previous value, starting from `initial`.
+    '''
+    hi = x > on
+    lo = x < off
+    last = np.where(hi | lo, np.arange(len(x)), -1)
+    last = np.maximum.accumulate(last) if len(x) > 0 else last
+    return np.where(last >= 0, hi[np.maximum(last, 0)], initial)
+
+def flags_to_intervals(flags, hop, min_dur=0.0, max_gap=0.0):
+    '''Convert per-frame booleans into intervals.
+flags = boolean array, one value per frame
+hop = frame length in seconds
+min_dur = drop intervals shorter than this, in seconds
+max_gap = merge intervals separated by this or less, in seconds
+Return an (n, 2) array of interval start and end times in seconds.
+'''
+    d = np.diff(np.concatenate([[0], np.asarray(flags, dtype=np.int8), [0]]))
+    iv = np.stack(
+        [np.flatnonzero(d == 1), np.flatnonzero(d == -1)], axis=1
+    ) * hop
+    if len(iv) > 1 and max_gap > 0:
+        split = (iv[1:, 0] - iv[:-1, 1]) > max_gap
+        iv = np.stack([
+            iv[np.concatenate([[True], split]), 0],
+            iv[np.concatenate([split, [True]]), 1]
+        ], axis=1)
+    return iv[(iv[:, 1] - iv[:, 0]) >= min_dur]
+
+@timed('voiced_intervals')
+def voiced_intervals(sig, rate, frame_secs=0.04, min_db=-40, min_corr=0.5,
+    f0min=60, f0max=500, min_dur=0.05, max_gap=0.04, blocksize=1048576):
+    '''Find voiced regions of an audio or lx signal.
+sig = 1d numpy array of samples; may be a view of a memory-mapped file
+rate = sample rate of sig
+frame_secs = analysis frame length in seconds
+min_db = minimum frame RMS, in dB re full scale
+min_corr = minimum normalized autocorrelation peak for lags in the f0 range
+f0min, f0max = f0 range in Hz
+min_dur, max_gap = see flags_to_intervals
+blocksize = approximate number of samples processed at a time
+Return an (n, 2) array of voiced interval start and end times in seconds.
+A frame is voiced if it is loud enough and periodic in the f0 range. sig
+is processed in blocks, so memory use does not depend on its length.
+'''
+    framelen = int(frame_secs * rate)
+    lag1 = max(1, int(rate / f0max))
+    lag2 = min(int(rate / f0min), framelen - 1)
+    nfft = int(2 ** np.ceil(np.log2(2 * framelen)))
+    # Correct the biased autocorrelation for the overlap at each lag.
+    unbias = framelen / (framelen - np.arange(lag1, lag2 + 1))
+    fs = full_scale(sig.dtype)
+    flags = [np.zeros(0, dtype=bool)]
+    for frames in _frame_blocks(sig, framelen, blocksize):
+        frames -= frames.mean(axis=1, keepdims=True)
+        rms = np.sqrt(np.mean(frames ** 2, axis=1))
+        db = 20 * np.log10(np.maximum(rms, 1e-9) / fs)
+        spec = np.fft.rfft(frames, n=nfft, axis=1)
+        ac = np.fft.irfft(np.abs(spec) ** 2, n=nfft, axis=1)
+        corr = (ac[:, lag1:lag2 + 1] * unbias).max(axis=1) / \
+            np.maximum(ac[:, 0], 1e-12)
+        flags.append((db > min_db) & (corr > min_corr))
+    return flags_to_intervals(
+        np.concatenate(flags), framelen / rate, min_dur, max_gap
+    )
+
+@timed('airflow_intervals')
+def airflow_intervals(sig, rate, on, off, zero=0.0, cutoff=50, order=3,
+    frame_secs=0.01, min_dur=0.02, blocksize=1048576):
+    '''Find airflow onsets and offsets in a flow channel.
+sig = 1d numpy array of samples; may be a view of a memory-mapped file
+rate = sample rate of sig
+on, off = hysteresis thresholds relative to zero; flow starts where the
+  lowpass filtered signal rises above on and ends where it falls below off
+zero = resting value of the channel, e.g. its _zero_ token mean
+cutoff, order = lowpass filter applied before thresholding
+frame_secs = time resolution of onsets and offsets in seconds
+min_dur = drop intervals shorter than this, in seconds
+blocksize = approximate number of samples processed at a time
+Return an (n, 2) array of airflow onset and offset times in seconds. The
+filter is applied causally across blocks, so memory use does not depend on
+the length of sig.
+'''
+    framelen = max(1, int(frame_secs * rate))
+    b, a = butter_lowpass(cutoff, rate, order=order)
+    zi = None
+    state = False
+    flags = [np.zeros(0, dtype=bool)]
+    for frames in _frame_blocks(sig, framelen, blocksize):
+        x = frames.ravel() - zero
+        if zi is None:
+            zi = scipy.signal.lfilter_zi(b, a) * x[0]
+        y, zi = scipy.signal.lfilter(b, a, x, zi=zi)
+        f = hysteresis(y.reshape(frames.shape).mean(axis=1), on, off, state)
+        state = bool(f[-1])
+        flags.append(f)
+    return flags_to_intervals(np.concatenate(flags), framelen / rate, min_dur)
+
+def mux_events(au, rate, p1, p2, flow_on, flow_off, cutoff=50, order=3):
+    '''Return a dict of the voiced regions and airflow intervals of a
+demultiplexed recording, keyed by 'voiced', 'p1 airflow' and 'p2 airflow'.
+Airflow thresholds flow_on and flow_off are relative to each channel's
+resting level, taken as its 10th percentile.
+'''
+    events = {'voiced': voiced_intervals(au, rate)}
+    for name, sig in (('p1 airflow', p1), ('p2 airflow', p2)):
+        rest = np.percentile(sig, 10)
+        events[name] = airflow_intervals(
+            sig, rate, flow_on, flow_off, zero=rest,
+            cutoff=cutoff, order=order
+        )
+    return events
+
+@timed('process_mux')
+def process_mux(data, rate, audio_first=True, cutoff=50, order=3, cal={},
+    decim_factor=2, flow_on=300, flow_off=150, dtype=None):
+    '''Process a multiplexed EGG-D800 recording for display.
+data = two-channel numpy array of multiplexed signal data
+rate = sample rate of data
+audio_first = interleave phase of data; see demux
+cutoff, order = lowpass filter applied to the aerodynamic channels
+cal = dict of calibration values keyed by 'p1' and 'p2', where each value
+  is a dict of 'slope', 'intercept' and 'zero_offset' (optional)
+decim_factor = decimation factor of the display channels
+flow_on, flow_off = airflow thresholds; see mux_events
+dtype = working precision; the default precision if None
+Return a dict of the demultiplexed channels at rate 'orig_rate' ('orig_au',
+'orig_lx', 'raw_p1', 'raw_p2'), their filtered and calibrated versions
+('raw_lp_p1', 'orig_p1', 'orig_lp_p1' and the same for p2), the decimated
+channels at rate 'rate' ('au', 'lx', 'p1', 'p2', 'raw_lp_decim_p1',
+'raw_lp_decim_p2', 'lp_p1', 'lp_p2'), their times 'timepts' and the
+'events' of mux_events.
+'''
+    (orig_au, orig_lx, raw_p1, raw_p2) = demux(data, audio_first=audio_first)
+    orig_rate = rate / 2     # each channel has half the rate of data
+    d = dict(
+        orig_rate=orig_rate,
+        orig_au=orig_au, orig_lx=orig_lx, raw_p1=raw_p1, raw_p2=raw_p2
+    )
+    for name, raw in (('p1', raw_p1), ('p2', raw_p2)):
+        raw_lp = butter_lowpass_filter(raw, cutoff, orig_rate, order, dtype)
+        if name in cal:
+            cal_p = calibrate(
+                raw_lp,
+                cal[name]['slope'],
+                cal[name]['intercept'],
+                cal[name]['zero_offset']
+            )
+        else:
+            cal_p = raw_lp
+        d['raw_lp_' + name] = raw_lp
+        d['orig_' + name] = cal_p
+        d['orig_lp_' + name] = butter_lowpass_filter(
+            cal_p, cutoff, orig_rate, order, dtype
+        )
+    d['rate'] = orig_rate / decim_factor
+    d['au'] = decimate(orig_au, decim_factor, dtype)
+    d['lx'] = decimate(orig_lx, decim_factor, dtype)
+    for name in ('p1', 'p2'):
+        d[name] = decimate(d['orig_' + name], decim_factor, dtype)
+        d['raw_lp_decim_' + name] = decimate(
+            d['raw_lp_' + name], decim_factor, dtype
+        )
+        d['lp_' + name] = butter_lowpass_filter(
+            d[name], cutoff, d['rate'], order, dtype
+        )
+    d['events'] = mux_events(
+        orig_au, orig_rate, raw_p1, raw_p2, flow_on, flow_off, cutoff, order
+    )
+    d['timepts'] = np.arange(0, len(d['au'])) / d['rate']
+    return d
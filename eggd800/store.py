@@ -0,0 +1,135 @@
+# Columnar storage of processed EGG-D800 channels.
+#
+# Processed channels are stored as chunked, compressed float32 columns so
+# that a later read of one channel or a short time range touches only the
+# chunks it needs. Zarr and Parquet are both supported; each requires its
+# own optional package (zarr or pyarrow).
+
+import json
+import numpy as np
+
+formats = ('zarr', 'parquet')
+
+def _import_zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise RuntimeError('The zarr package is required for .zarr stores.')
+    return zarr
+
+def _import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError('The pyarrow package is required for .parquet stores.')
+    return (pa, pq)
+
+def write_zarr(path, chans, rate, md={}, chunksize=65536):
+    '''Write dict of named channels to a Zarr group at path.
+chans = dict of channel name -> 1d numpy array
+rate = sample rate of the channels
+md = metadata to store in the group attributes
+chunksize = number of samples per chunk
+'''
+    zarr = _import_zarr()
+    g = zarr.open_group(str(path), mode='w')
+    g.attrs.update(dict(md, rate=rate, channels=list(chans.keys())))
+    # zarr 3 deprecates create_dataset in favour of create_array, which
+    # zarr 2 does not have.
+    create = getattr(g, 'create_array', None) or g.create_dataset
+    for cname, cdata in chans.items():
+        arr = create(
+            cname,
+            shape=(len(cdata),),
+            dtype='float32',
+            chunks=(chunksize,)
+        )
+        arr[:] = np.asarray(cdata, dtype=np.float32)
+    return path
+
+def write_parquet(path, chans, rate, md={}, chunksize=65536):
+    '''Write dict of named channels to a Parquet file at path.
+chans = dict of channel name -> 1d numpy array
+rate = sample rate of the channels
+md = metadata to store in the file's key-value metadata
+chunksize = number of samples per row group
+'''
+    pa, pq = _import_pyarrow()
+    table = pa.table(
+        {c: np.asarray(d, dtype=np.float32) for c, d in chans.items()}
+    )
+    table = table.replace_schema_metadata({
+        'eggd800': json.dumps(
+            dict(md, rate=rate, channels=list(chans.keys()))
+        )
+    })
+    pq.write_table(table, str(path), row_group_size=chunksize, compression='zstd')
+    return path
+
+def write_store(path, chans, rate, md={}, chunksize=65536, fmt='zarr'):
+    '''Write dict of named channels to a store in format fmt.'''
+    if fmt == 'zarr':
+        return write_zarr(path, chans, rate, md=md, chunksize=chunksize)
+    elif fmt == 'parquet':
+        return write_parquet(path, chans, rate, md=md, chunksize=chunksize)
+    else:
+        raise RuntimeError('Unknown store format "{:}".'.format(fmt))
+
+def read_zarr(path, chan=None, t1=None, t2=None):
+    '''Read channels from a Zarr group written by write_zarr.
+chan = list of channel names to read (default all)
+t1, t2 = start and end times in seconds (default whole recording)
+Return (rate, chans, md), where chans is a dict of channel name -> array.
+Only the chunks that overlap [t1, t2) are read.
+'''
+    zarr = _import_zarr()
+    g = zarr.open_group(str(path), mode='r')
+    md = dict(g.attrs)
+    rate = md['rate']
+    chan = md['channels'] if chan is None else chan
+    nrows = g[md['channels'][0]].shape[0] if len(md['channels']) > 0 else 0
+    s1 = 0 if t1 is None else max(int(np.round(t1 * rate)), 0)
+    s2 = nrows if t2 is None else min(int(np.round(t2 * rate)), nrows)
+    chans = {c: g[c][s1:s2] for c in chan}
+    return (rate, chans, md)
+
+def read_parquet(path, chan=None, t1=None, t2=None):
+    '''Read channels from a Parquet file written by write_parquet.
+chan = list of channel names to read (default all)
+t1, t2 = start and end times in seconds (default whole recording)
+Return (rate, chans, md), where chans is a dict of channel name -> array.
+Only the row groups that overlap [t1, t2) are read.
+'''
+    pa, pq = _import_pyarrow()
+    pf = pq.ParquetFile(str(path))
+    md = json.loads(pf.schema_arrow.metadata[b'eggd800'])
+    rate = md['rate']
+    chan = md['channels'] if chan is None else chan
+    nrows = pf.metadata.num_rows
+    s1 = 0 if t1 is None else max(int(np.round(t1 * rate)), 0)
+    s2 = nrows if t2 is None else min(int(np.round(t2 * rate)), nrows)
+    groups = []
+    offset = 0
+    first = None
+    for gidx in range(pf.metadata.num_row_groups):
+        glen = pf.metadata.row_group(gidx).num_rows
+        if offset < s2 and offset + glen > s1:
+            groups.append(gidx)
+            if first is None:
+                first = offset
+        offset += glen
+    if len(groups) == 0:
+        return (rate, {c: np.empty([0], dtype=np.float32) for c in chan}, md)
+    table = pf.read_row_groups(groups, columns=chan)
+    chans = {
+        c: table.column(c).to_numpy()[s1 - first:s2 - first] for c in chan
+    }
+    return (rate, chans, md)
+
+def read_store(path, chan=None, t1=None, t2=None):
+    '''Read channels from a store, choosing the format from the path suffix.'''
+    if str(path).endswith('.parquet'):
+        return read_parquet(path, chan=chan, t1=t1, t2=t2)
+    else:
+        return read_zarr(path, chan=chan, t1=t1, t2=t2)
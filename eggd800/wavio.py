@@ -0,0 +1,202 @@
+# Block-streaming rewrites of .wav files.
+#
+# rewrite_wav() copies the sample data of a .wav file to a new file in
+# fixed-size blocks read through a memory map, optionally reordering,
+# selecting or offsetting channels on the way. Memory use does not depend on
+# the length of the recording. The new file is written to a temporary file
+# in the destination directory and renamed into place when complete, so a
+# failed rewrite never leaves a partial file, and the destination may be the
+# source file itself.
+
+import os
+import mmap
+import struct
+import tempfile
+import numpy as np
+from eggd800 import instrument
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+def read_header(wav):
+    '''Read the chunk layout of a RIFF .wav file.
+Return a dict with keys:
+  'chunks' = list of (id, offset, size) of every chunk, where offset is the
+    position of the chunk data
+  'fmt' = bytes of the format chunk data
+  'format_tag', 'nchan', 'rate', 'bits' = fields of the format chunk; for
+    WAVE_FORMAT_EXTENSIBLE the format_tag is taken from the subformat
+  'data_offset', 'data_size' = position and size of the sample data
+'''
+    hdr = {'chunks': []}
+    with open(wav, 'rb') as fh:
+        (riff, _, wave) = struct.unpack('<4sI4s', fh.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise RuntimeError(f'{wav} is not a RIFF WAVE file.')
+        filesize = os.fstat(fh.fileno()).st_size
+        pos = 12
+        while pos + 8 <= filesize:
+            fh.seek(pos)
+            (cid, size) = struct.unpack('<4sI', fh.read(8))
+            hdr['chunks'].append((cid, pos + 8, size))
+            if cid == b'fmt ':
+                hdr['fmt'] = fh.read(size)
+            elif cid == b'data':
+                # Some recorders leave the data size unset; use the rest
+                # of the file.
+                if size == 0 or pos + 8 + size > filesize:
+                    size = filesize - pos - 8
+                    hdr['chunks'][-1] = (cid, pos + 8, size)
+                hdr['data_offset'] = pos + 8
+                hdr['data_size'] = size
+            pos += 8 + size + size % 2
+    if 'fmt' not in hdr or 'data_offset' not in hdr:
+        raise RuntimeError(f'{wav} has no format or data chunk.')
+    (tag, nchan, rate, _, _, bits) = struct.unpack('<HHIIHH', hdr['fmt'][:16])
+    if tag == WAVE_FORMAT_EXTENSIBLE and len(hdr['fmt']) >= 26:
+        tag = struct.unpack('<H', hdr['fmt'][24:26])[0]
+    hdr.update({'format_tag': tag, 'nchan': nchan, 'rate': rate, 'bits': bits})
+    return hdr
+
+def sample_dtype(hdr):
+    '''Return the numpy dtype of the samples described by a read_header() dict.'''
+    tag = hdr['format_tag']
+    bits = hdr['bits']
+    if tag == WAVE_FORMAT_PCM and bits == 8:
+        return np.dtype('u1')
+    if tag == WAVE_FORMAT_PCM and bits in (16, 32, 64):
+        return np.dtype(f'<i{bits // 8}')
+    if tag == WAVE_FORMAT_IEEE_FLOAT and bits in (32, 64):
+        return np.dtype(f'<f{bits // 8}')
+    raise RuntimeError(
+        f'Unsupported .wav sample format {tag:#06x} with {bits} bits.'
+    )
+
+def _fmt_for_nchan(fmt, nchan, keep_mask):
+    '''
+    Return format chunk bytes fmt with the channel count, byte rate and
+    block align updated for nchan channels. Other fields, including any
+    extension, are preserved, except that the speaker position mask of
+    WAVE_FORMAT_EXTENSIBLE is cleared unless keep_mask is True.
+    '''
+    (tag, oldn, rate, _, _, bits) = struct.unpack('<HHIIHH', fmt[:16])
+    if nchan == oldn:
+        return fmt
+    align = nchan * (bits // 8)
+    fmt = bytearray(fmt)
+    fmt[:16] = struct.pack(
+        '<HHIIHH', tag, nchan, rate, rate * align, align, bits
+    )
+    if tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 24 and keep_mask is False:
+        fmt[20:24] = struct.pack('<I', 0)
+    return bytes(fmt)
+
+def _copy_blocks(samples, out, columns, offsets, dtype, blocksize):
+    '''Write columns of samples to out in blocks, subtracting offsets.'''
+    for start in range(0, samples.shape[0], blocksize):
+        block = samples[start:start + blocksize, columns]
+        if offsets is not None:
+            block = block - offsets
+            if np.issubdtype(dtype, np.integer):
+                info = np.iinfo(dtype)
+                block = np.clip(np.rint(block), info.min, info.max)
+            block = block.astype(dtype)
+        out.write(np.ascontiguousarray(block).tobytes())
+
+def rewrite_wav(src, dst, columns=None, offsets=None, blocksize=65536):
+    '''Copy a .wav file in blocks, rearranging or adjusting its channels.
+src = source .wav file
+dst = destination .wav file; may be the same as src
+columns = source columns in output order, e.g. a permutation or a subset
+  of the channels (optional; default all columns in their original order)
+offsets = per-source-column values subtracted from the samples, e.g. the
+  channel means of a _zero_ token (optional). Integer samples are rounded
+  and clipped to the range of the sample type.
+blocksize = number of sample frames copied at a time
+The format chunk and the other chunks of src are copied unchanged, except
+for the fields that depend on the number of channels.
+Return dst.
+'''
+    hdr = read_header(src)
+    dtype = sample_dtype(hdr)
+    nchan = hdr['nchan']
+    if columns is None:
+        columns = list(range(nchan))
+    columns = [int(c) for c in columns]
+    if len(columns) == 0 or min(columns) < 0 or max(columns) >= nchan:
+        raise RuntimeError(
+            f'Columns {columns} out of range for {nchan} channels.'
+        )
+    if offsets is not None:
+        offsets = np.asarray(offsets, dtype=np.float64)
+        if offsets.shape != (nchan,):
+            raise RuntimeError(f'Expected {nchan} offsets, got {len(offsets)}.')
+        offsets = offsets[columns]
+        if np.all(offsets == 0):
+            offsets = None
+    nframes = hdr['data_size'] // (nchan * dtype.itemsize)
+    fmt = _fmt_for_nchan(
+        hdr['fmt'], len(columns), sorted(columns) == list(range(nchan))
+    )
+    datasize = nframes * len(columns) * dtype.itemsize
+
+    dst = os.fspath(dst)
+    dstdir = os.path.dirname(os.path.abspath(dst))
+    (fd, tmpname) = tempfile.mkstemp(
+        dir=dstdir, prefix='.' + os.path.basename(dst), suffix='.tmp'
+    )
+    try:
+        with instrument.span('rewrite_wav', fname=str(src)), \
+            os.fdopen(fd, 'wb') as out:
+            out.write(b'RIFF\0\0\0\0WAVE')
+            with open(src, 'rb') as fh:
+                for (cid, offset, size) in hdr['chunks']:
+                    if cid == b'data':
+                        break
+                    if cid == b'fmt ':
+                        out.write(struct.pack('<4sI', cid, len(fmt)))
+                        out.write(fmt + b'\0' * (len(fmt) % 2))
+                    else:
+                        out.write(struct.pack('<4sI', cid, size))
+                        fh.seek(offset)
+                        out.write(fh.read(size + size % 2))
+            out.write(struct.pack('<4sI', b'data', datasize))
+            if nframes > 0:
+                # The map is closed before src is replaced, which Windows
+                # requires when dst is src.
+                with open(src, 'rb') as fh, \
+                    mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    samples = np.ndarray(
+                        (nframes, nchan), dtype=dtype, buffer=mm,
+                        offset=hdr['data_offset']
+                    )
+                    try:
+                        _copy_blocks(
+                            samples, out, columns, offsets, dtype, blocksize
+                        )
+                    finally:
+                        # The map cannot be closed while an array uses it.
+                        del samples
+            if datasize % 2 == 1:
+                out.write(b'\0')
+            # Chunks that follow the sample data, e.g. LIST metadata.
+            seen_data = False
+            with open(src, 'rb') as fh:
+                for (cid, offset, size) in hdr['chunks']:
+                    if seen_data is True:
+                        fh.seek(offset)
+                        out.write(struct.pack('<4sI', cid, size))
+                        out.write(fh.read(size + size % 2))
+                    seen_data = seen_data or cid == b'data'
+            riffsize = out.tell() - 8
+            out.seek(4)
+            out.write(struct.pack('<I', riffsize))
+        os.chmod(tmpname, os.stat(src).st_mode & 0o777)
+        os.replace(tmpname, dst)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+    instrument.count('rewrite_wav_bytes', datasize)
+    return dst
@@ -0,0 +1,74 @@
+# Per-recording metadata stored in a sidecar .yaml file.
+#
+# Facts derived from a .wav file, e.g. its detected channel order, are
+# stored next to it in <stem>.yaml so that they are computed once. Each
+# sidecar records the size and modification time of its .wav file, and a
+# sidecar that no longer matches its .wav file is ignored.
+
+import os
+from pathlib import Path
+import yaml
+
+def meta_path(wav):
+    '''Return the path of the sidecar metadata file for wav.'''
+    return Path(wav).with_suffix('.yaml')
+
+def _stat(wav):
+    st = os.stat(wav)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+def load_meta(wav):
+    '''
+    Return the sidecar metadata for wav as a dict. The dict is empty if
+    there is no sidecar or if wav has changed since it was written.
+    '''
+    try:
+        with open(meta_path(wav), 'r') as fh:
+            md = yaml.safe_load(fh) or {}
+    except FileNotFoundError:
+        return {}
+    if md.get('wav') != _stat(wav):
+        return {}
+    return md
+
+def save_meta(wav, **kwargs):
+    '''Add kwargs to the sidecar metadata for wav and return the metadata.'''
+    md = load_meta(wav)
+    md.update(kwargs)
+    md['fname'] = os.path.basename(wav)
+    md['wav'] = _stat(wav)
+    with open(meta_path(wav), 'w') as fh:
+        yaml.dump(md, fh, sort_keys=False)
+    return md
+
+def cached_audio_first(wav, data=None):
+    '''
+    Return the interleave phase of multiplexed recording wav, True if the
+    first sample contains audio data. The phase is detected on first use
+    and cached in the sidecar metadata, where a value set with
+    set_audio_first takes precedence. If the sidecar cannot be written,
+    e.g. in a read-only directory, the detected phase is returned without
+    caching it.
+    '''
+    from eggd800.signal import detect_audio_first
+    md = load_meta(wav)
+    if 'audio_first' in md:
+        return md['audio_first']
+    if data is None:
+        import scipy.io.wavfile
+        (rate, data) = scipy.io.wavfile.read(wav, mmap=True)
+    audio_first, score = detect_audio_first(data)
+    try:
+        save_meta(
+            wav,
+            audio_first=bool(audio_first),
+            audio_first_score=round(score, 4),
+            audio_first_source='detected'
+        )
+    except OSError:
+        pass
+    return bool(audio_first)
+
+def set_audio_first(wav, audio_first):
+    '''Record a user-selected interleave phase for wav.'''
+    save_meta(wav, audio_first=bool(audio_first), audio_first_source='user')